@@ -8,12 +8,12 @@ import locale
 import math
 import numpy
 import pkg_resources
+import threading
 
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import YEARLY, MONTHLY, DAILY, HOURLY, MINUTELY, SECONDLY
 from django.http import HttpResponse
 from django.utils import simplejson as json
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.dates import AutoDateFormatter
 from matplotlib.dates import AutoDateLocator
 from matplotlib.dates import DateFormatter
@@ -24,6 +24,8 @@ from matplotlib.dates import rrulewrapper
 from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
 from matplotlib.ticker import ScalarFormatter
+from lizard_map import downsampling
+from lizard_map import render_pool
 from lizard_map.matplotlib_settings import FONT_SIZE
 from lizard_map.matplotlib_settings import SCREEN_DPI
 
@@ -82,14 +84,68 @@ def adapter_serialize(o):
     return json.dumps(o).replace('"', '%22').replace(' ', '%20')
 
 
+# Entry points and loaded adapter classes, see adapter_registry().
+_registry = None
+_adapter_classes = {}
+_registry_lock = threading.Lock()
+
+
+def adapter_registry():
+    """Return list of (name, entrypoint) of all adapters.
+
+    Scanning the entry points is slow, so it's done once per process.
+    Call reload_adapters() to scan again, for instance after
+    installing a plugin in a running process (or in tests).
+    """
+    global _registry
+    registry = _registry
+    if registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = [
+                    (entrypoint.name, entrypoint) for entrypoint in
+                    pkg_resources.iter_entry_points(
+                        group=ADAPTER_ENTRY_POINT)]
+            registry = _registry
+    return registry
+
+
+def reload_adapters():
+    """Forget the entry points and adapter classes found so far."""
+    global _registry
+    with _registry_lock:
+        _registry = None
+        _adapter_classes.clear()
+
+
+def load_adapter_class(adapter_class):
+    """Return adapter class for entry point name adapter_class.
+
+    Classes are loaded once per process, see adapter_registry().
+    """
+    try:
+        return _adapter_classes[adapter_class]
+    except KeyError:
+        pass
+    for name, entrypoint in adapter_registry():
+        if name == adapter_class:
+            try:
+                adapter = entrypoint.load()
+            except ImportError, e:
+                logger.critical("Invalid entry point: %s", e)
+                raise
+            _adapter_classes[adapter_class] = adapter
+            return adapter
+    raise AdapterClassNotFoundError(
+        u'Entry point for %r not found' % adapter_class)
+
+
 def adapter_class_names():
     """Return allowed layer method names (from entrypoints)
 
     in tuple of 2-tuples
     """
-    entrypoints = [(entrypoint.name, entrypoint.name) for entrypoint in
-                   pkg_resources.iter_entry_points(group=ADAPTER_ENTRY_POINT)]
-    return tuple(entrypoints)
+    return tuple([(name, name) for name, _ in adapter_registry()])
 
 
 def adapter_layer_arguments(layer_json):
@@ -111,20 +167,10 @@ def adapter_entrypoint(adapter_class, layer_arguments, workspace_item=None):
 
     Optionally give workspace_item, for legacy (must be factored out).
     """
-    # TODO: this happens more often than needed! Cache it.
-    for entrypoint in pkg_resources.iter_entry_points(
-        group=ADAPTER_ENTRY_POINT):
-        if entrypoint.name == adapter_class:
-            try:
-                adapter = entrypoint.load()
-            except ImportError, e:
-                logger.critical("Invalid entry point: %s", e)
-                raise
-            return adapter(workspace_item,
-                           layer_arguments=layer_arguments,
-                           adapter_class=adapter_class)
-    raise AdapterClassNotFoundError(
-        u'Entry point for %r not found' % adapter_class)
+    adapter = load_adapter_class(adapter_class)
+    return adapter(workspace_item,
+                   layer_arguments=layer_arguments,
+                   adapter_class=adapter_class)
 
 
 # Graph stuff
@@ -230,6 +276,13 @@ class MultilineAutoDateFormatter(AutoDateFormatter):
         self.axes = axes
         self.tickinfo = None
 
+    def __getstate__(self):
+        # Tickinfo is a nested class, so it can't be pickled (see
+        # render_pool). It is calculated again when needed.
+        state = self.__dict__.copy()
+        state['tickinfo'] = None
+        return state
+
     def __call__(self, x, pos=0):
 
         scale = float(self._locator._get_unit())
@@ -369,6 +422,24 @@ class MultilineAutoDateFormatter(AutoDateFormatter):
             return date2num(middle_of_year)
 
 
+def date_numbers(datetimes):
+    """Return array of matplotlib's date2num() of datetimes.
+
+    Much faster than date2num() for long lists. Like date2num(), naive
+    datetimes are taken to be UTC.
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    seconds = numpy.zeros(len(datetimes))
+    for index, value in enumerate(datetimes):
+        if not isinstance(value, datetime.datetime):
+            # Date.
+            value = datetime.datetime(value.year, value.month, value.day)
+        elif value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        seconds[index] = (value - epoch).total_seconds()
+    return seconds / (24 * 3600) + date2num(epoch)
+
+
 class Graph(object):
     """
     Class for matplotlib graphs, i.e. for popups, krw graphs
@@ -438,6 +509,40 @@ class Graph(object):
         # Show line for today.
         self.axes.axvline(self.today, color='orange', lw=1, ls='--')
 
+    def reduce_points(self, xvalues, yvalues):
+        """Return xvalues, yvalues with at most two points per pixel.
+
+        Per pixel column of the axes the lowest and highest point are
+        kept, so peaks remain visible. Series that are small enough are
+        returned unchanged.
+        """
+        num_pixels = max(int(self.width * (
+                    1 - self.legend_width - self.left_label_width)), 1)
+        if len(xvalues) <= 2 * num_pixels:
+            return xvalues, yvalues
+        is_date = isinstance(xvalues[0], datetime.date)
+        if is_date:
+            xvalues = date_numbers(xvalues)
+        xvalues, yvalues = downsampling.min_max_downsample(
+            xvalues, yvalues, num_pixels)
+        if is_date:
+            xvalues = num2date(xvalues, tz=self.tz)
+        return xvalues, yvalues
+
+    def plot(self, xvalues, yvalues, *args, **kwargs):
+        """self.axes.plot() with at most two points per pixel.
+
+        Plotting many more points than there are pixels is slow and
+        doesn't show anything extra.
+        """
+        xvalues, yvalues = self.reduce_points(list(xvalues), list(yvalues))
+        return self.axes.plot(xvalues, yvalues, *args, **kwargs)
+
+    def bar(self, xvalues, yvalues, *args, **kwargs):
+        """self.axes.bar() with at most two bars per pixel."""
+        xvalues, yvalues = self.reduce_points(list(xvalues), list(yvalues))
+        return self.axes.bar(xvalues, yvalues, *args, **kwargs)
+
     def set_ylim_margin(self, top=0.1, bottom=0.0):
         """Adjust y-margin of axes.
 
@@ -663,10 +768,9 @@ class Graph(object):
                 l.set_verticalalignment('baseline')
                 l.set_position((0, -0.05))
 
-        canvas = FigureCanvas(self.figure)
-        response = HttpResponse(content_type='image/png')
-        canvas.print_png(response)
-        return response
+        # In a worker process if MAP_GRAPH_RENDER_PROCESSES is set.
+        png = render_pool.render_png(self.figure)
+        return HttpResponse(png, content_type='image/png')
 
     def render(self):
         '''
@@ -684,6 +788,108 @@ def mk_js_timestamp(datetime_utc):
     return float(time.mktime(datetime_utc.timetuple()) * 1000)
 
 
+def _isdst(value):
+    """Return tm_isdst like value.timetuple() would."""
+    dst = value.dst()
+    if dst is None:
+        return -1
+    return int(bool(dst))
+
+
+def mk_js_timestamps(datetimes):
+    """
+    Return float array of mk_js_timestamp() of all datetimes.
+
+    Instead of time.mktime() per datetime, the local time offset is
+    looked up once per hour in the data.
+    """
+    datetimes = list(datetimes)
+    if not datetimes:
+        return numpy.zeros(0)
+    if not all([isinstance(value, datetime.datetime)
+                for value in datetimes]):
+        # Dates.
+        datetimes = [datetime.datetime(*value.timetuple()[:6])
+                     for value in datetimes]
+    isdst = numpy.zeros(len(datetimes), dtype=int) - 1
+    if any([value.tzinfo is not None for value in datetimes]):
+        isdst = numpy.array([_isdst(value) for value in datetimes])
+        datetimes = [value.replace(tzinfo=None) for value in datetimes]
+    # Seconds since 1970 as if the wall clock time were UTC, truncated.
+    epoch = datetime.datetime(1970, 1, 1)
+    wall_clock = numpy.floor(numpy.array(
+            [(value - epoch).total_seconds() for value in datetimes])
+        ).astype(numpy.int64)
+    hours = wall_clock // 3600
+    keys, inverse = numpy.unique(hours * 3 + (isdst + 1),
+                                 return_inverse=True)
+    offsets = numpy.zeros(len(keys))
+    for index, key in enumerate(keys):
+        hour_start = (key // 3) * 3600
+        time_tuple = time.gmtime(hour_start)[:8] + (key % 3 - 1, )
+        offsets[index] = hour_start - time.mktime(time_tuple)
+    return (wall_clock - offsets[inverse]) * 1000.0
+
+
+def downsample_flot_data(flot_data, width):
+    """Return flot_data with the lines reduced to min/max per pixel.
+
+    Only series with lines are reduced; bars and the filled percentile
+    areas (which have an 'id') are returned as they are.
+    """
+    result = []
+    for series in flot_data:
+        if (series.get('lines', {}).get('show') and 'id' not in series
+            and not series.get('bars', {}).get('show') and
+            len(series.get('data', ())) > 2 * width):
+            series = dict(series)
+            xs, ys = zip(*series['data'])
+            xs, ys = downsampling.min_max_downsample(xs, ys, width)
+            series['data'] = zip(xs.tolist(), _nan_to_none(ys))
+        result.append(series)
+    return result
+
+
+def flot_data_since(flot_data, since):
+    """Return flot_data with only the points after timestamp since."""
+    result = []
+    for series in flot_data:
+        series = dict(series)
+        series['data'] = [point for point in series.get('data', [])
+                          if point[0] > since]
+        result.append(series)
+    return result
+
+
+def _nan_to_none(values):
+    """Return list of values with NaN (not valid json) as None."""
+    return [None if value != value else value for value in values.tolist()]
+
+
+def columnar_flot_data(flot_data, delta=False):
+    """Return flot_data with 'data' pairs split into 'x' and 'y' lists.
+
+    With delta, 'x' is the first x followed by the differences, which
+    is much smaller for regular timeseries; 'x_delta' is then True.
+    """
+    result = []
+    for series in flot_data:
+        series = dict(series)
+        data = series.pop('data', [])
+        if data:
+            xs, ys = zip(*data)
+        else:
+            xs, ys = [], []
+        xs = numpy.asarray(xs, dtype=float)
+        if delta and len(xs):
+            xs = numpy.concatenate((xs[:1], numpy.diff(xs)))
+            series['x_delta'] = True
+        series['x'] = xs.tolist()
+        series['y'] = _nan_to_none(numpy.asarray(ys, dtype=float))
+        result.append(series)
+    return result
+
+
 class FlotGraphAxes(object):
     legend_ = None
 
@@ -729,7 +935,7 @@ class FlotGraphAxes(object):
         label=None
     ):
         # convert xvalues to timestamps for flot.js
-        xvalues = [mk_js_timestamp(x) for x in xvalues]
+        xvalues = mk_js_timestamps(xvalues).tolist()
         self._update_y_limits(yvalues)
         self.flot_data.append({
             'label': label,
@@ -747,7 +953,7 @@ class FlotGraphAxes(object):
         label=None
     ):
         # convert xvalues to timestamps for flot.js
-        xvalues = [mk_js_timestamp(x) for x in xvalues]
+        xvalues = mk_js_timestamps(xvalues).tolist()
         self._update_y_limits(yvalues)
         self.flot_data.append({
             'label': label,
@@ -810,6 +1016,13 @@ class FlotGraph(object):
         # Should add a vertical line for the current day?
         pass
 
+    def plot(self, xvalues, yvalues, *args, **kwargs):
+        """Same as Graph.plot(); the flot data is reduced in the view."""
+        return self.axes.plot(xvalues, yvalues, *args, **kwargs)
+
+    def bar(self, xvalues, yvalues, *args, **kwargs):
+        return self.axes.bar(xvalues, yvalues, *args, **kwargs)
+
     def set_xlabel(self, xlabel):
         self.xlabel = xlabel
 
@@ -905,7 +1118,10 @@ class FlotGraph(object):
             id_string = "{0}-percentile-{1}".format(label, key)
 
             # Change UTC datetimes into JS timestamps here
-            data = [[mk_js_timestamp(ts), value] for ts, value in data]
+            data = list(data)
+            timestamps = mk_js_timestamps([ts for ts, value in data])
+            data = [[timestamp, value] for timestamp, (ts, value)
+                    in zip(timestamps.tolist(), data)]
 
             self.axes.flot_data.append({
                     "id": id_string,
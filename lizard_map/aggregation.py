@@ -0,0 +1,108 @@
+"""
+Aggregate values of a timeseries, see
+WorkspaceItemAdapter.value_aggregate().
+
+The values are put in a sorted numpy array once; all aggregates are then
+computed from that array. Custom aggregates can be added with
+register_aggregate().
+"""
+import logging
+import math
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+_aggregates = {}
+
+
+def register_aggregate(name, function):
+    """Register function as aggregate name.
+
+    function(values, argument) gets a sorted float array without NaNs
+    (possibly empty) and the argument from aggregate_functions. It returns
+    the aggregated value or None.
+    """
+    _aggregates[name] = function
+
+
+def sorted_values(values):
+    """Return sorted float array of values, without None and NaN.
+
+    Raises ValueError or TypeError if values aren't numbers.
+    """
+    result = numpy.array(values, dtype=float)
+    result = result[~numpy.isnan(result)]
+    result.sort()
+    return result
+
+
+def percentile(values, percent):
+    """Return linearly interpolated percentile of sorted values."""
+    if not len(values) or percent is None:
+        return None
+    rank = min(max(percent, 0), 100) / 100.0 * (len(values) - 1)
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(values) - 1)
+    fraction = rank - lower
+    return float(values[lower] + (values[upper] - values[lower]) * fraction)
+
+
+def _minimum(values, argument):
+    if len(values):
+        return float(values[0])
+
+
+def _maximum(values, argument):
+    if len(values):
+        return float(values[-1])
+
+
+def _average(values, argument):
+    if len(values):
+        return float(values.mean())
+
+
+def _count_lt(values, boundary):
+    if boundary is not None:
+        return int(numpy.searchsorted(values, boundary, side='left'))
+
+
+def _count_gte(values, boundary):
+    if boundary is not None:
+        return len(values) - int(
+            numpy.searchsorted(values, boundary, side='left'))
+
+
+register_aggregate('min', _minimum)
+register_aggregate('max', _maximum)
+register_aggregate('avg', _average)
+register_aggregate('count_lt', _count_lt)
+register_aggregate('count_gte', _count_gte)
+register_aggregate('percentile', percentile)
+
+
+def aggregate(values, aggregate_functions):
+    """Return dict with the aggregate_functions of values.
+
+    aggregate_functions is a dict of {name: argument}, see
+    WorkspaceItemAdapter.value_aggregate(). Unknown names and
+    aggregates of non-numeric values are None.
+    """
+    try:
+        values = sorted_values(values)
+    except (ValueError, TypeError):
+        logger.warning("Can't aggregate non-numeric values")
+        return dict([(name, None) for name in aggregate_functions])
+
+    result = {}
+    for name, argument in aggregate_functions.items():
+        function = _aggregates.get(name)
+        result_value = None
+        if function is not None:
+            try:
+                result_value = function(values, argument)
+            except (ValueError, IndexError, TypeError, ZeroDivisionError):
+                logger.exception("Error in aggregate %s", name)
+        result[name] = result_value
+    return result
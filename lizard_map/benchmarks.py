@@ -0,0 +1,295 @@
+"""
+Benchmarks of performance sensitive code, comparing it with the original
+(slower) implementation where there is one.
+
+Run with ``python -m lizard_map.benchmarks``, with DJANGO_SETTINGS_MODULE
+set for the benchmarks that need the database models. The functions are
+also used in the tests to check that the results are identical.
+"""
+import contextlib
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+import pkg_resources
+
+from lizard_map import adapter
+from lizard_map.spatial_index import SpatialIndex
+from lizard_map.symbol_manager import SymbolManager
+
+SYMBOL_COLORS = [(1.0, 1.0, 1.0, 1.0), (1.0, 0.0, 0.0, 1.0),
+                 (0.2, 0.5, 0.8, 1.0)]
+SYMBOL_SHADOW_HEIGHTS = [0, 3]
+
+
+class LegacySymbolManager(SymbolManager):
+    """SymbolManager with the original per-pixel transformations."""
+
+    @staticmethod
+    def colorize(im, im_mask, color):
+        # Create objects where you can read and write pixel values.
+        pix = im.load()
+        pix_mask = im_mask.load()
+        for x in range(im.size[0]):
+            for y in range(im.size[1]):
+                mask = pix_mask[x, y][3]
+                r, g, b, a = pix[x, y]
+                r = (int(color[0] * r * mask / 256) +
+                     r * (255 - mask) / 256)
+                g = (int(color[1] * g * mask / 256) +
+                     g * (255 - mask) / 256)
+                b = (int(color[2] * b * mask / 256) +
+                     b * (255 - mask) / 256)
+                pix[x, y] = (r, g, b, a)
+
+    @staticmethod
+    def composite(im, im_shadow):
+        pix = im.load()
+        pix_shadow = im_shadow.load()
+        for x in range(im_shadow.size[0]):
+            for y in range(im_shadow.size[1]):
+                r, g, b, a = pix_shadow[x, y]
+                r2, g2, b2, a2 = pix[x, y]
+                r_res = r2 * a2 / 256 + r * a * (255 - a2) / 256 / 256
+                g_res = g2 * a2 / 256 + g * a * (255 - a2) / 256 / 256
+                b_res = b2 * a2 / 256 + b * a * (255 - a2) / 256 / 256
+                a_res = a2 + (255 - a2) * a / 256
+                pix_shadow[x, y] = (r_res, g_res, b_res, a_res)
+
+
+def icon_names():
+    """Return names of the icons that have a mask."""
+    path = pkg_resources.resource_filename('lizard_map', 'icons')
+    names = sorted(os.listdir(path))
+    return [name for name in names
+            if name.endswith('.png') and not name.endswith('_mask.png') and
+            name.replace('.png', '_mask.png') in names]
+
+
+def _generate_symbols(symbol_manager_class, generated_path):
+    """Generate all symbol variations, return (seconds, {filename: data})."""
+    original_path = pkg_resources.resource_filename('lizard_map', 'icons')
+    symbol_manager = symbol_manager_class(original_path, generated_path)
+    filenames = []
+    start = time.time()
+    for icon in icon_names():
+        mask = icon.replace('.png', '_mask.png')
+        for color in SYMBOL_COLORS:
+            for shadow_height in SYMBOL_SHADOW_HEIGHTS:
+                filenames.append(symbol_manager.get_symbol_transformed(
+                        icon, mask=(mask, ), color=color,
+                        shadow_height=(shadow_height, ), force=True))
+    seconds = time.time() - start
+    result = {}
+    for filename in filenames:
+        with open(os.path.join(generated_path, filename), 'rb') as f:
+            result[filename] = f.read()
+    return seconds, result
+
+
+def compare_symbol_managers():
+    """Generate all icons with the legacy and the current SymbolManager.
+
+    Returns (legacy seconds, current seconds, list of filenames whose
+    output differs).
+    """
+    legacy_path = tempfile.mkdtemp()
+    current_path = tempfile.mkdtemp()
+    try:
+        legacy_seconds, legacy = _generate_symbols(
+            LegacySymbolManager, legacy_path)
+        current_seconds, current = _generate_symbols(
+            SymbolManager, current_path)
+    finally:
+        shutil.rmtree(legacy_path)
+        shutil.rmtree(current_path)
+    different = sorted([filename for filename in legacy
+                        if legacy[filename] != current.get(filename)])
+    return legacy_seconds, current_seconds, different
+
+
+def legacy_load_adapter_class(adapter_class):
+    """Original lookup: scan all entry points on every call."""
+    for entrypoint in pkg_resources.iter_entry_points(
+        group=adapter.ADAPTER_ENTRY_POINT):
+        if entrypoint.name == adapter_class:
+            return entrypoint.load()
+    raise adapter.AdapterClassNotFoundError(
+        u'Entry point for %r not found' % adapter_class)
+
+
+@contextlib.contextmanager
+def legacy_adapter_lookup():
+    """Scan all entry points on every adapter lookup, like originally."""
+    # Needs configured django settings.
+    from lizard_map import models
+
+    current = adapter.load_adapter_class, models.load_adapter_class
+    adapter.load_adapter_class = legacy_load_adapter_class
+    models.load_adapter_class = legacy_load_adapter_class
+    try:
+        yield
+    finally:
+        adapter.load_adapter_class, models.load_adapter_class = current
+        adapter.reload_adapters()
+
+
+def benchmark_page_render(num_items=20, num_requests=5,
+                          adapter_class='adapter_dummy'):
+    """Time GETs of the map page with num_items workspace items.
+
+    The django test client gets a session whose edit workspace has
+    num_items items; the workspace is removed afterwards. Returns
+    (legacy seconds, current seconds) per page: with the entry points
+    scanned on every adapter lookup and with the adapter registry.
+    """
+    # Needs configured django settings and a database.
+    from django.test.client import Client
+    from django.utils.importlib import import_module
+    from lizard_map.models import WorkspaceEdit
+    from lizard_map.models import WorkspaceEditItem
+
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session.save()
+    client = Client()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+    workspace = WorkspaceEdit(session_key=session.session_key)
+    workspace.save()
+    url = reverse('lizard_ui.icons')
+
+    def render_pages():
+        start = time.time()
+        for i in range(num_requests):
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    "%s returned %s" % (url, response.status_code))
+        return (time.time() - start) / num_requests
+
+    try:
+        for i in range(num_items):
+            WorkspaceEditItem(workspace=workspace, name='Item %d' % i,
+                              index=i, adapter_class=adapter_class,
+                              adapter_layer_json='{}').save()
+        # Load the templates and the like first.
+        client.get(url)
+        with legacy_adapter_lookup():
+            legacy_seconds = render_pages()
+        current_seconds = render_pages()
+    finally:
+        workspace.delete()
+        session.delete()
+    return legacy_seconds, current_seconds
+
+
+def benchmark_adapter_lookup(num_items=20, accesses_per_item=5,
+                             adapter_class='adapter_dummy'):
+    """Time the adapter lookups of rendering a page with num_items items.
+
+    A map page accesses workspace_item.adapter about accesses_per_item
+    times per item (legends, wms_layers, is_animatable, ...). The first
+    access of an item looks up its adapter class, the others are memo
+    hits on the item. Every run gets new items so that earlier runs
+    don't fill the memo.
+
+    Returns (legacy seconds, registry seconds, memo seconds): the page
+    with every access scanning the entry points, the page with every
+    access looking up the class in the registry, and the memo hits of
+    the page with the current code.
+    """
+    # Needs configured django settings.
+    from lizard_map.models import WorkspaceEditItem
+
+    def new_items():
+        return [WorkspaceEditItem(adapter_class=adapter_class,
+                                  adapter_layer_json='{}')
+                for i in range(num_items)]
+
+    def access_all(workspace_items):
+        start = time.time()
+        for workspace_item in workspace_items:
+            workspace_item.adapter
+        return time.time() - start
+
+    def lookup_page():
+        # Without the memo, every access is a lookup.
+        return sum([access_all(new_items())
+                    for i in range(accesses_per_item)])
+
+    with legacy_adapter_lookup():
+        legacy_seconds = lookup_page()
+    # Fill the registry once, as the first request of a process does.
+    access_all(new_items())
+    registry_seconds = lookup_page()
+
+    workspace_items = new_items()
+    access_all(workspace_items)
+    memo_seconds = sum([access_all(workspace_items)
+                        for i in range(accesses_per_item - 1)])
+    return legacy_seconds, registry_seconds, memo_seconds
+
+
+def benchmark_spatial_index(num_points=100000, num_queries=100,
+                            radius=1000.0):
+    """Time radius searches by looping over all points versus SpatialIndex.
+
+    Points are spread randomly over the Netherlands (google
+    coordinates). Returns (loop seconds, index build seconds, index
+    query seconds).
+    """
+    rnd = random.Random(0)
+    points = [(rnd.uniform(350000, 800000), rnd.uniform(6550000, 7100000), i)
+              for i in range(num_points)]
+    queries = [(rnd.uniform(350000, 800000), rnd.uniform(6550000, 7100000))
+               for _ in range(num_queries)]
+
+    start = time.time()
+    for x, y in queries:
+        sorted([(math.hypot(px - x, py - y), item)
+                for px, py, item in points
+                if math.hypot(px - x, py - y) <= radius])
+    loop_seconds = time.time() - start
+
+    start = time.time()
+    index = SpatialIndex(points)
+    build_seconds = time.time() - start
+    start = time.time()
+    for x, y in queries:
+        index.radius(x, y, radius)
+    query_seconds = time.time() - start
+    return loop_seconds, build_seconds, query_seconds
+
+
+def main():
+    legacy_seconds, current_seconds, different = compare_symbol_managers()
+    print "SymbolManager: %.3fs per-pixel, %.3fs vectorized, %d different" % (
+        legacy_seconds, current_seconds, len(different))
+    for filename in different:
+        print "    %s" % filename
+    loop_seconds, build_seconds, query_seconds = benchmark_spatial_index()
+    print ("Radius search in 100k points, 100 queries: %.3fs looping, "
+           "%.3fs building index + %.3fs querying" % (
+            loop_seconds, build_seconds, query_seconds))
+    try:
+        legacy_seconds, registry_seconds, memo_seconds = (
+            benchmark_adapter_lookup())
+    except (ImportError, ImproperlyConfigured):
+        # Django settings are not configured.
+        print "Adapter lookup: skipped, run with DJANGO_SETTINGS_MODULE"
+    else:
+        print ("Adapter lookup for 20 items: %.3fs scanning, %.3fs "
+               "registry, %.3fs memo hits" % (
+                legacy_seconds, registry_seconds, memo_seconds))
+        legacy_seconds, current_seconds = benchmark_page_render()
+        print ("Map page with 20 items: %.3fs scanning, %.3fs registry" % (
+                legacy_seconds, current_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+Size-bounded cache of generated files (map tiles, graphs) on disk.
+
+The cache lives in a plain directory, so multiple WSGI worker processes
+can share it. Files are written atomically (write to a temporary file,
+then rename) and the least recently used files are removed when the
+directory grows beyond its maximum size.
+
+Walking the directory is expensive, so every process keeps an estimate
+of the size: it only walks the directory when its estimate is above the
+maximum size or the last walk is check_interval seconds ago (to see
+what other processes wrote). A lock file makes sure only one process
+walks at a time.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+try:
+    import fcntl
+except ImportError:
+    # Not on unix: processes don't coordinate their eviction runs.
+    fcntl = None
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = 'tmp-'
+# After an eviction run, the cache is at most this fraction of max_size.
+LOW_WATER_MARK = 0.9
+# Unfinished temporary files older than this (in seconds) are removed.
+TEMP_FILE_MAX_AGE = 3600
+LOCK_FILENAME = 'evict.lock'
+
+
+def cache_key(*parts):
+    """Return hex digest identifying the given key parts.
+
+    Parts can be anything with a stable repr, like strings, numbers
+    and tuples of those.
+    """
+    key = '\n'.join([repr(part) for part in parts])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+class DiskCache(object):
+    """Cache of files on disk with least-recently-used eviction.
+
+    The access time of a file is used as LRU clock: it is set
+    explicitly on every hit, so it works regardless of mount
+    options. The modification time is the moment of writing and is
+    used for ``max_age``.
+    """
+
+    def __init__(self, path, max_size, max_age=None, extension='.png',
+                 check_interval=300):
+        """
+        - path: directory to store the files in, created if needed.
+        - max_size: maximum total size in bytes.
+        - max_age: optional default maximum age of a file in seconds.
+        - check_interval: maximum number of seconds between eviction
+          runs, to notice the writes of other processes.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.extension = extension
+        self.check_interval = check_interval
+        # Estimated total size, None until the first eviction run.
+        self._size = None
+        self._last_evict = 0
+
+    def filename(self, key):
+        """Return absolute filename for key (a cache_key() digest)."""
+        return os.path.join(self.path, key[:2], key + self.extension)
+
+    def get(self, key, max_age=None):
+        """Return cached data for key, or None."""
+        if max_age is None:
+            max_age = self.max_age
+        filename = self.filename(key)
+        try:
+            if max_age is not None:
+                if time.time() - os.path.getmtime(filename) > max_age:
+                    return None
+            with open(filename, 'rb') as cached_file:
+                data = cached_file.read()
+            # Mark as recently used.
+            os.utime(filename, (time.time(), os.path.getmtime(filename)))
+        except (IOError, OSError):
+            # Not there, or removed by another process in the meantime.
+            return None
+        return data
+
+    def set(self, key, data):
+        """Store data under key.
+
+        Writing happens to a temporary file in the same directory which
+        is then renamed, so other processes never read half a file.
+        """
+        filename = self.filename(key)
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        except OSError:
+            # Probably created by another process in the meantime.
+            pass
+        try:
+            handle, temp_filename = tempfile.mkstemp(
+                prefix=TEMP_PREFIX, dir=directory)
+            try:
+                os.write(handle, data)
+            finally:
+                os.close(handle)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError):
+            logger.exception("Could not write %s to disk cache", filename)
+            return
+
+        if self._size is not None:
+            self._size += len(data)
+        if (self._size is None or self._size > self.max_size or
+            time.time() - self._last_evict > self.check_interval):
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used files until we're below max_size.
+
+        Does nothing if another process is evicting already.
+        """
+        self._last_evict = time.time()
+        lock_file = self._lock()
+        if lock_file is False:
+            return
+        try:
+            self._size = self._evict()
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def _lock(self):
+        """Return the locked lock file, None if locking isn't possible
+        or False if another process has the lock."""
+        if fcntl is None:
+            return None
+        try:
+            lock_file = open(os.path.join(self.path, LOCK_FILENAME), 'a')
+        except IOError:
+            # Probably no directory yet.
+            return None
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        return lock_file
+
+    def _evict(self):
+        """Walk the cache and evict, return the resulting size."""
+        now = time.time()
+        entries = []
+        total_size = 0
+        for directory, _, filenames in os.walk(self.path):
+            for name in filenames:
+                if name == LOCK_FILENAME:
+                    continue
+                filename = os.path.join(directory, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                if name.startswith(TEMP_PREFIX):
+                    if now - stat.st_mtime > TEMP_FILE_MAX_AGE:
+                        self._remove(filename)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, filename))
+                total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return total_size
+        logger.debug("Disk cache %s is %d bytes, evicting...",
+                     self.path, total_size)
+        entries.sort()
+        low_water_mark = self.max_size * LOW_WATER_MARK
+        for _, size, filename in entries:
+            if total_size <= low_water_mark:
+                break
+            self._remove(filename)
+            total_size -= size
+        return total_size
+
+    def clear(self):
+        """Remove all cached files."""
+        for directory, _, filenames in os.walk(self.path):
+            for name in filenames:
+                self._remove(os.path.join(directory, name))
+        self._size = 0
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            # Already removed by another process.
+            pass
+
+
+_tile_cache = None
+
+
+def tile_cache():
+    """Return the DiskCache for rendered WMS tiles, or None if disabled.
+
+    The cache is off unless MAP_TILE_CACHE_MAX_SIZE is set, in bytes:
+    adapters that show live data would otherwise get stale tiles. Also
+    configure MAP_TILE_CACHE_DIR (default: ``generated_tiles`` in
+    MEDIA_ROOT) and MAP_TILE_CACHE_TIMEOUT in seconds (default one hour,
+    None means tiles never expire).
+    """
+    global _tile_cache
+    if _tile_cache is None:
+        max_size = getattr(settings, 'MAP_TILE_CACHE_MAX_SIZE', 0)
+        if not max_size:
+            return None
+        path = getattr(settings, 'MAP_TILE_CACHE_DIR',
+                       os.path.join(settings.MEDIA_ROOT, 'generated_tiles'))
+        _tile_cache = DiskCache(
+            path, max_size,
+            max_age=getattr(settings, 'MAP_TILE_CACHE_TIMEOUT', 3600))
+    return _tile_cache
+
+
+_graph_cache = None
+
+
+def graph_cache():
+    """Return the DiskCache for rendered graphs, or None if disabled.
+
+    The cache is off unless MAP_GRAPH_CACHE_MAX_SIZE is set, in bytes,
+    see WorkspaceItemAdapter.image_data_version(). Also configure
+    MAP_GRAPH_CACHE_DIR (default: ``generated_graphs`` in MEDIA_ROOT)
+    and MAP_GRAPH_CACHE_TIMEOUT in seconds (default ten minutes, None
+    means graphs never expire).
+    """
+    global _graph_cache
+    if _graph_cache is None:
+        max_size = getattr(settings, 'MAP_GRAPH_CACHE_MAX_SIZE', 0)
+        if not max_size:
+            return None
+        path = getattr(settings, 'MAP_GRAPH_CACHE_DIR',
+                       os.path.join(settings.MEDIA_ROOT, 'generated_graphs'))
+        _graph_cache = DiskCache(
+            path, max_size,
+            max_age=getattr(settings, 'MAP_GRAPH_CACHE_TIMEOUT', 600))
+    return _graph_cache
@@ -0,0 +1,54 @@
+"""
+Reduce timeseries to what can be seen in a graph of a given width.
+
+A graph of 400 pixels wide can't show more than 400 different x values,
+but one that gets 100k points still has to transfer, parse and draw all
+of them. min_max_downsample() keeps the lowest and highest point per
+pixel column, so peaks remain visible.
+"""
+import numpy
+
+
+def min_max_indexes(xs, ys, num_buckets):
+    """Return sorted indexes of the min and max y per x bucket.
+
+    xs must be sorted. ys may contain NaNs (gaps): a bucket with only
+    NaNs keeps one, so the gap remains visible.
+    """
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if len(xs) <= 2 * num_buckets:
+        return numpy.arange(len(xs))
+    span = xs[-1] - xs[0]
+    if span <= 0:
+        buckets = numpy.zeros(len(xs), dtype=int)
+    else:
+        buckets = ((xs - xs[0]) / span * num_buckets).astype(int)
+        buckets = numpy.minimum(buckets, num_buckets - 1)
+
+    valid = ~numpy.isnan(ys)
+    # Sort by bucket, then by y (NaNs last); the first of every bucket
+    # is its minimum, respectively maximum.
+    order_min = numpy.lexsort(
+        (numpy.where(valid, ys, numpy.inf), buckets))
+    order_max = numpy.lexsort(
+        (numpy.where(valid, -ys, numpy.inf), buckets))
+    starts = numpy.concatenate(
+        ([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+    return numpy.unique(numpy.concatenate(
+            (order_min[starts], order_max[starts])))
+
+
+def min_max_downsample(xs, ys, num_buckets):
+    """Return (xs, ys) arrays with the min and max point per bucket.
+
+    Buckets are num_buckets equal parts of the x range, typically the
+    pixel columns of the graph. Series with at most two points per
+    bucket are returned as they are (as arrays, sorted by x).
+    """
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    order = numpy.argsort(xs, kind='mergesort')
+    xs, ys = xs[order], ys[order]
+    indexes = min_max_indexes(xs, ys, num_buckets)
+    return xs[indexes], ys[indexes]
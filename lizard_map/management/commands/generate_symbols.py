@@ -0,0 +1,129 @@
+"""
+Pre-generate the symbols of all point legends, for instance after a deploy.
+
+Without pre-generating, the first map loads generate them one by one in
+LegendPoint.mapnik_style().
+"""
+import multiprocessing
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from lizard_map.mapnik_helper import get_symbol_manager
+from lizard_map.models import Legend
+from lizard_map.models import LegendPoint
+from lizard_map.symbol_manager import list_image_file_names
+
+GENERATED = 'generated'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def legend_colors(legend):
+    """Return all colors a legend can draw with."""
+    colors = [legend.default_color, legend.too_low_color,
+              legend.too_high_color]
+    colors.extend([legend_value['color']
+                   for legend_value in legend.legend_values()])
+    return [color for color in colors if color and color.r is not None]
+
+
+def icon_mask(icon, icon_names):
+    """Return mask for icon: icon_mask.png if there is one."""
+    base, extension = os.path.splitext(icon)
+    mask = base + '_mask' + extension
+    if mask in icon_names:
+        return mask
+    return icon
+
+
+def symbols(all_icons=False):
+    """Return sorted list of (icon, mask, color tuple) to generate.
+
+    These are the icons and colors of all LegendPoints. With all_icons,
+    all icons are combined with the colors of all Legends.
+    """
+    result = set()
+    for legend in LegendPoint.objects.all():
+        for color in legend_colors(legend):
+            result.add((legend.icon, legend.mask or legend.icon,
+                        color.to_tuple()))
+    if all_icons:
+        icon_names = [name for name, _ in list_image_file_names()]
+        colors = set()
+        for legend in Legend.objects.all():
+            colors.update([color.to_tuple()
+                           for color in legend_colors(legend)])
+        for icon in icon_names:
+            if '_mask.' in icon:
+                continue
+            for color in colors:
+                result.add((icon, icon_mask(icon, icon_names), color))
+    return sorted(result)
+
+
+def generate_symbol(symbol):
+    """Generate symbol, return (filename, GENERATED/SKIPPED/FAILED).
+
+    Runs in a worker process.
+    """
+    icon, mask, color = symbol
+    symbol_manager = get_symbol_manager()
+    icon_style = {'mask': (mask, ), 'color': color}
+    filename = symbol_manager.symbol_filename(icon, **icon_style)
+    if os.path.isfile(os.path.join(symbol_manager.symbol_path_generated,
+                                   filename)):
+        return filename, SKIPPED
+    try:
+        symbol_manager.get_symbol_transformed(icon, **icon_style)
+    except Exception:
+        # Probably a legend with a non-existing icon or mask.
+        return filename, FAILED
+    return filename, GENERATED
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Generate the symbols of all point legends. Existing symbols '
+            'are skipped.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all-icons',
+                    action='store_true',
+                    dest='all_icons',
+                    default=False,
+                    help='Generate all icons in the colors of all legends'),
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=None,
+                    help='Number of worker processes (default: #cpus)'),
+        )
+
+    def handle(self, *args, **options):
+        todo = symbols(all_icons=options['all_icons'])
+        self.stdout.write('%d symbols to check.\n' % len(todo))
+        # Don't share the database connection with the workers.
+        connection.close()
+
+        pool = multiprocessing.Pool(processes=options['processes'])
+        counts = {GENERATED: 0, SKIPPED: 0, FAILED: 0}
+        verbose = int(options.get('verbosity', 1)) > 1
+        try:
+            for done, (filename, status) in enumerate(
+                pool.imap_unordered(generate_symbol, todo, chunksize=10)):
+                counts[status] += 1
+                if status == FAILED:
+                    self.stderr.write('Could not generate %s\n' % filename)
+                elif status == GENERATED and verbose:
+                    self.stdout.write('Generated %s\n' % filename)
+                if (done + 1) % 100 == 0:
+                    self.stdout.write('%d/%d...\n' % (done + 1, len(todo)))
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write(
+            'Done: %d generated, %d already there, %d failed.\n' % (
+                counts[GENERATED], counts[SKIPPED], counts[FAILED]))
@@ -3,11 +3,13 @@ Mapnik helper functions
 """
 import logging
 import os
+import threading
 
 import mapnik
 from django.conf import settings
 
 from lizard_map.symbol_manager import SymbolManager
+from lizard_map.utility import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -92,26 +94,44 @@ def create_layer_from_query(query, projection, geometry_field=None, srid=None,
     return layer
 
 
+_symbol_manager = None
+
+
+def get_symbol_manager():
+    """Return the process-wide SymbolManager for generated_icons.
+
+    It remembers which symbols are already generated, so the disk is
+    only touched for new symbols. MAP_SYMBOL_CACHE_SIZE is the number
+    of symbols to remember (default 1000), with MAP_SYMBOL_CACHE_DATA
+    the png data is kept in memory as well.
+
+    TODO: Move ICON_ORIGINALS from lizard_map.models to here?
+    """
+    global _symbol_manager
+    if _symbol_manager is None:
+        from lizard_map.models import ICON_ORIGINALS
+        _symbol_manager = SymbolManager(
+            ICON_ORIGINALS,
+            os.path.join(settings.MEDIA_ROOT, 'generated_icons'),
+            cache_size=getattr(settings, 'MAP_SYMBOL_CACHE_SIZE', 1000),
+            keep_data=getattr(settings, 'MAP_SYMBOL_CACHE_DATA', False))
+    return _symbol_manager
+
+
 def symbol_filename(icon, mask, color):
     """
     Generates symbol and returns symbol filename. Uses SymbolManager
     to generate icons.
 
-    TODO: Move ICON_ORIGINALS from lizard_map.models to here?
-
     Input:
     icon: icon filename, i.e. empty.png
     mask: mask filename,
     color: color tuple, i.e. (1.0, 1.0, 1.0, 1.0)
     """
-    from lizard_map.models import ICON_ORIGINALS
-
     icon_style = {'icon': icon,
                   'mask': (mask, ),
                   'color': color.to_tuple()}
-    symbol_manager = SymbolManager(
-        ICON_ORIGINALS,
-        os.path.join(settings.MEDIA_ROOT, 'generated_icons'))
+    symbol_manager = get_symbol_manager()
     output_filename = symbol_manager.get_symbol_transformed(
         icon_style['icon'], **icon_style)
     return output_filename
@@ -148,3 +168,93 @@ def add_datasource_point(datasource, x, y, name, info):
     around = [(0, 0), (e, 0), (-e, 0), (0, e), (0, -e)]
     for offset_x, offset_y in around:
         datasource.add_point(x + offset_x, y + offset_y, name, info)
+
+
+class MapPool(object):
+    """Per-process pool of prepared mapnik.Map objects.
+
+    Preparing a map (adapter.layer(), building styles and symbols) is
+    often more expensive than rendering it. Prepared maps are kept
+    under a key that identifies their contents, so a request only has
+    to zoom and render. A mapnik.Map can be used by one thread at a
+    time: take it out with checkout() and put it back with checkin().
+    """
+
+    def __init__(self, max_size=100, max_idle=4, max_age=None):
+        """
+        - max_size: number of keys to keep maps for.
+        - max_idle: number of idle maps to keep per key.
+        - max_age: optional number of seconds after which the maps of a
+          key are prepared again, to pick up changed data.
+        """
+        self.max_idle = max_idle
+        self._maps = LRUCache(max_size, ttl=max_age)
+        self._lock = threading.Lock()
+
+    def checkout(self, key):
+        """Return an idle map for key, or None."""
+        with self._lock:
+            maps = self._maps.get(key)
+            if maps:
+                return maps.pop()
+        return None
+
+    def checkin(self, key, mapnik_map):
+        """Return a map to the pool."""
+        with self._lock:
+            maps = self._maps.get(key)
+            if maps is None:
+                maps = []
+                self._maps.set(key, maps)
+            if len(maps) < self.max_idle:
+                maps.append(mapnik_map)
+
+    def clear(self):
+        self._maps.clear()
+
+
+_map_pool = None
+
+
+def map_pool():
+    """Return the per-process MapPool, or None if disabled.
+
+    The pool is off unless MAP_MAPNIK_POOL_SIZE is set to the number of
+    workspace item contents to keep maps for: adapters whose layer()
+    uses live data or the request would otherwise draw outdated maps.
+    Adapters with ``tile_cacheable = False`` are never pooled. Pooled
+    maps are prepared again after MAP_MAPNIK_POOL_TIMEOUT seconds
+    (default 300, None keeps them until they're evicted).
+    """
+    global _map_pool
+    if _map_pool is None:
+        max_size = getattr(settings, 'MAP_MAPNIK_POOL_SIZE', 0)
+        if not max_size:
+            return None
+        _map_pool = MapPool(
+            max_size,
+            max_age=getattr(settings, 'MAP_MAPNIK_POOL_TIMEOUT', 300))
+    return _map_pool
+
+
+def checkout_map(key, width, height):
+    """Return prepared map for key from the map_pool(), resized.
+
+    Returns None if there is none, the caller has to prepare a new one
+    and hand it to checkin_map() afterwards.
+    """
+    pool = map_pool()
+    if key is None or pool is None:
+        return None
+    mapnik_map = pool.checkout(key)
+    if mapnik_map is not None:
+        mapnik_map.resize(width, height)
+    return mapnik_map
+
+
+def checkin_map(key, mapnik_map):
+    """Put map back in the map_pool() for the next request."""
+    pool = map_pool()
+    if key is None or pool is None:
+        return
+    pool.checkin(key, mapnik_map)
@@ -1,8 +1,12 @@
+import copy
 import datetime
+import hashlib
 import logging
 import random
 import string
+import time
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
@@ -19,13 +23,19 @@ import pkg_resources
 
 from lizard_map import dateperiods
 from lizard_map import fields
+from lizard_map import tiles
+from lizard_map import workers
 from lizard_map.adapter import AdapterClassNotFoundError
 from lizard_map.adapter import adapter_class_names
 from lizard_map.adapter import adapter_entrypoint
 from lizard_map.adapter import adapter_layer_arguments
 from lizard_map.adapter import adapter_serialize
+from lizard_map.adapter import load_adapter_class
+from lizard_map.daterange import SESSION_DT_END
+from lizard_map.daterange import SESSION_DT_START
 from lizard_map.exceptions import WorkspaceItemError
 from lizard_map.mapnik_helper import point_rule
+from lizard_map.utility import LRUCache
 # Temporary, because fewsjdbc api handler imports this.
 from lizard_map.adapter import ADAPTER_ENTRY_POINT
 
@@ -53,6 +63,9 @@ LOCATION_ENTRY_POINT = 'lizard_map.location_method'
 # WMS is a special kind of adapter: the client side behaves different.
 ADAPTER_CLASS_WMS = 'wms'
 
+# Session key for custom legends, see views.legend_edit.
+CUSTOM_LEGENDS = 'custom_legends'
+
 logger = logging.getLogger(__name__)
 
 
@@ -165,6 +178,38 @@ class BackgroundMapMixin(models.Model):
         abstract = True
 
 
+_stateless_adapters = None
+
+
+def stateless_adapter(workspace_item):
+    """Return adapter for workspace_item if its adapter is stateless.
+
+    Adapters with ``is_stateless = True`` only depend on their adapter
+    class and layer json. One instance per layer json is kept in this
+    process (MAP_STATELESS_ADAPTER_CACHE_SIZE, default 500) and a
+    shallow copy bound to workspace_item is returned. Returns None for
+    other adapters.
+    """
+    global _stateless_adapters
+    adapter_class = load_adapter_class(workspace_item.adapter_class)
+    if not getattr(adapter_class, 'is_stateless', False):
+        return None
+    if _stateless_adapters is None:
+        _stateless_adapters = LRUCache(getattr(
+                settings, 'MAP_STATELESS_ADAPTER_CACHE_SIZE', 500))
+    key = (workspace_item.adapter_class, workspace_item.adapter_layer_json)
+    cached_adapter = _stateless_adapters.get(key)
+    if cached_adapter is None:
+        cached_adapter = adapter_entrypoint(
+            workspace_item.adapter_class,
+            workspace_item._adapter_layer_arguments, None)
+        _stateless_adapters.set(key, cached_adapter)
+    result = copy.copy(cached_adapter)
+    result.workspace_mixin_item = workspace_item
+    result.workspace_item = workspace_item
+    return result
+
+
 class WorkspaceItemMixin(models.Model):
     """
     Workspace item
@@ -195,10 +240,23 @@ class WorkspaceItemMixin(models.Model):
 
     @property
     def adapter(self):
+        """Return adapter instance of this item.
+
+        The instance is kept on the item as long as adapter_class and
+        adapter_layer_json don't change. Adapters that declare
+        themselves ``is_stateless`` are also shared between requests,
+        see stateless_adapter().
+        """
+        memo_key = (self.adapter_class, self.adapter_layer_json)
+        memo = self.__dict__.get('_adapter_memo')
+        if memo is not None and memo[0] == memo_key:
+            return memo[1]
         try:
-            layer_arguments = self._adapter_layer_arguments
-            current_adapter = adapter_entrypoint(
-                self.adapter_class, layer_arguments, self)
+            current_adapter = stateless_adapter(self)
+            if current_adapter is None:
+                layer_arguments = self._adapter_layer_arguments
+                current_adapter = adapter_entrypoint(
+                    self.adapter_class, layer_arguments, self)
         except (WorkspaceItemError, AdapterClassNotFoundError):
             logger.exception(
                 "Deleting problematic WorkspaceItem: %s", self)
@@ -207,8 +265,38 @@ class WorkspaceItemMixin(models.Model):
                 # Only delete if it is saved in the first place.
                 self.delete()
             return None
+        self._adapter_memo = (memo_key, current_adapter)
         return current_adapter
 
+    def content_key(self, request=None):
+        """Return hash of what this item draws, for caching its output.
+
+        Items with the same adapter class and layer json draw the same,
+        except when the adapter depends on the period (animatable
+        adapters) or on a custom legend in the session. Those are
+        added if a request is given. None is returned if the output
+        cannot be cached, for instance when the period is relative to
+        'now'. The key changes whenever a Legend is changed.
+        """
+        parts = [self.adapter_class, self.adapter_layer_json]
+        adapter = self.adapter
+        if adapter is None or not adapter.tile_cacheable:
+            return None
+        if request is not None:
+            session = request.session
+            if adapter.is_animatable:
+                dt_start = session.get(SESSION_DT_START, None)
+                dt_end = session.get(SESSION_DT_END, None)
+                if dt_start is None or dt_end is None:
+                    return None
+                parts.extend([str(dt_start), str(dt_end)])
+            if adapter.allow_custom_legend:
+                custom_legends = session.get(CUSTOM_LEGENDS, {})
+                parts.append(json.dumps(custom_legends, sort_keys=True))
+        parts.append(legend_version())
+        return hashlib.sha1(
+            u'\n'.join(parts).encode('utf-8')).hexdigest()
+
     def __unicode__(self):
         return self.name
 
@@ -218,7 +306,8 @@ class WorkspaceItemMixin(models.Model):
 
         Used when duplicating WorkspaceStorageItems to
         WorkspaceEditItems and vice versa."""
-        delete_fields = ['_state', '_workspace_cache', 'workspace_id', 'id']
+        delete_fields = ['_state', '_workspace_cache', 'workspace_id', 'id',
+                         '_adapter_memo']
 
         # Get current data in dict.
         kwargs = self.__dict__
@@ -256,6 +345,44 @@ class WorkspaceItemMixin(models.Model):
         url += '?' + '&'.join(self._url_arguments(identifiers))
         return url
 
+    def cached_extent(self):
+        """Return adapter.extent(), cached per adapter class and layer json.
+
+        Returns None if the extent is unknown (or partly unknown). The
+        cache timeout is MAP_EXTENT_CACHE_TIMEOUT seconds (default one
+        hour).
+        """
+        cache_key = 'lizard-map.extent.%s' % hashlib.sha1(
+            (u'%s\n%s' % (self.adapter_class, self.adapter_layer_json)
+             ).encode('utf-8')).hexdigest()
+        extent = cache.get(cache_key)
+        if extent is None:
+            try:
+                extent = self.adapter.extent()
+            except:
+                logger.exception("Error when calling .extent()")
+                extent = None
+            if (not isinstance(extent, dict) or
+                None in [extent.get(key) for key in
+                         ('west', 'east', 'south', 'north')]):
+                # Cache 'unknown' as well.
+                extent = {}
+            cache.set(cache_key, extent,
+                      getattr(settings, 'MAP_EXTENT_CACHE_TIMEOUT', 3600))
+        return extent or None
+
+    def extent_contains(self, x, y, radius=None):
+        """Return whether (google) x, y is within radius of the extent.
+
+        True if the extent is unknown.
+        """
+        extent = self.cached_extent()
+        if extent is None:
+            return True
+        radius = radius or 0
+        return (extent['west'] - radius <= x <= extent['east'] + radius and
+                extent['south'] - radius <= y <= extent['north'] + radius)
+
     def has_extent(self):
         """Return true if this workspace item's adapter can
         successfully compute an extent and doesn't have "None" in the
@@ -393,7 +520,7 @@ class WorkspaceModelMixin(object):
                     url = reverse(
                         'lizard_map_workspace_edit_wms',
                         kwargs={'workspace_item_id': workspace_item.id})
-                return {
+                result = {
                     'wms_id': workspace_item.id,
                     'name': workspace_item.name,
                     'url': url,
@@ -401,6 +528,35 @@ class WorkspaceModelMixin(object):
                     'options': options,
                     'index': workspace_item.index,
                 }
+                if getattr(settings, 'MAP_TILED_WORKSPACE_LAYERS', False):
+                    result.update(tile_data(workspace_item))
+                return result
+
+        def tile_data(workspace_item):
+            """Return tile url template and options of the tile() view."""
+            grid = tiles.srs_to_grid.get(
+                Setting.get('projection', 'EPSG:900913'))
+            if grid is None:
+                return {}
+            kwargs = {'workspace_item_id': workspace_item.id,
+                      'grid_name': grid.name, 'zoom': 0, 'x': 0, 'y': 0}
+            if isinstance(workspace_item, WorkspaceStorageItem):
+                kwargs['workspace_storage_id'] = workspace_item.workspace.id
+                url = reverse('lizard_map_workspace_storage_tile',
+                              kwargs=kwargs)
+            else:
+                url = reverse('lizard_map_workspace_edit_tile', kwargs=kwargs)
+            # OpenLayers.Layer.XYZ fills in the tile coordinates.
+            url = url[:-len('0/0/0.png')] + '${z}/${x}/${y}.png'
+            options = grid.openlayers_options()
+            options.update({
+                'transitionEffect': 'resize',
+                'displayInLayerSwitcher': False,
+                'isBaseLayer': False,
+                'opacity': 1.0,
+            })
+            return {'tile_url': url, 'tile_options': json.dumps(options)}
+
         return [to_template_data(workspace_item)
                 for workspace_item in self.workspace_items.all()
                 if workspace_item.visible]
@@ -726,41 +882,130 @@ class CollageEditItem(WorkspaceItemMixin, StatisticsMixin):
         # Calc periods based on aggregation period setting.
         periods = dateperiods.calc_aggregation_periods(start_date, end_date,
                                            self.aggregation_period)
-        statistics = []
-        for period_start_date, period_end_date in periods:
+        periods = [
+            (period_start_date, period_end_date)
+            for period_start_date, period_end_date in periods
             if not self.restrict_to_month or (
                 self.aggregation_period != dateperiods.MONTH) or (
                 self.aggregation_period == dateperiods.MONTH and
-                self.restrict_to_month == period_start_date.month):
-
-                # Base statistics for each period.
-                statistics_row = adapter.value_aggregate(
-                    self.identifier,
-                    {'min': None,
-                     'max': None,
-                     'avg': None,
-                     'count_lt': self.boundary_value,
-                     'count_gte': self.boundary_value,
-                     'percentile': self.percentile_value},
-                    start_date=period_start_date,
-                    end_date=period_end_date)
-
-                # Add name.
-                if statistics_row:
-                    statistics_row['name'] = self.name
-                    statistics_row['period'] = dateperiods.fancy_period(
-                        period_start_date, period_end_date,
-                        self.aggregation_period)
-                    statistics_row['boundary_value'] = self.boundary_value
-                    statistics_row['percentile_value'] = self.percentile_value
-                    statistics.append(statistics_row)
+                self.restrict_to_month == period_start_date.month)]
+
+        # Base statistics for each period.
+        statistics_rows = adapter.value_aggregate_periods(
+            self.identifier,
+            {'min': None,
+             'max': None,
+             'avg': None,
+             'count_lt': self.boundary_value,
+             'count_gte': self.boundary_value,
+             'percentile': self.percentile_value},
+            periods)
+
+        statistics = []
+        for (period_start_date, period_end_date), statistics_row in zip(
+            periods, statistics_rows):
+            # Add name.
+            if statistics_row:
+                statistics_row['name'] = self.name
+                statistics_row['period'] = dateperiods.fancy_period(
+                    period_start_date, period_end_date,
+                    self.aggregation_period)
+                statistics_row['boundary_value'] = self.boundary_value
+                statistics_row['percentile_value'] = self.percentile_value
+                statistics.append(statistics_row)
         return statistics
 
 
+def collage_items_statistics(collage_items, start_date, end_date):
+    """Return statistics rows of all collage_items, in order.
+
+    The items are calculated concurrently (see lizard_map.workers). An
+    item that fails or runs for more than MAP_STATISTICS_TIMEOUT seconds
+    (default 30, counted from when the item starts, not from when it is
+    queued) gets a single row with the error as period.
+    """
+    collage_items = list(collage_items)
+    # Get the adapters here: it can delete broken collage items.
+    for collage_item in collage_items:
+        collage_item.adapter
+
+    def item_statistics(collage_item):
+        return collage_item.statistics(start_date, end_date)
+
+    if len(collage_items) > 1:
+        results = workers.concurrent_map(
+            item_statistics, collage_items,
+            timeout=getattr(settings, 'MAP_STATISTICS_TIMEOUT', 30),
+            per_item=True)
+    else:
+        results = [(item_statistics(collage_item), None)
+                   for collage_item in collage_items]
+
+    statistics = []
+    for collage_item, (rows, error) in zip(collage_items, results):
+        if error is None:
+            statistics.extend(rows)
+            continue
+        if isinstance(error, workers.WorkerTimeout):
+            logger.warning("Statistics of %s timed out", collage_item)
+            message = _('Timed out')
+        else:
+            logger.error("Error in statistics of %s: %r", collage_item, error)
+            message = _('Error')
+        statistics.append({
+                'name': collage_item.name,
+                'period': message,
+                'min': None,
+                'max': None,
+                'avg': None,
+                'count_lt': None,
+                'count_gte': None,
+                'percentile': None,
+                'boundary_value': collage_item.boundary_value,
+                'percentile_value': collage_item.percentile_value})
+    return statistics
+
 # TODO: Remove legend-shape dependencies of legend stuff, then remove
 # the legend stuff.
 
 
+LEGEND_VERSION_KEY = 'lizard-map.Legend.version'
+LEGEND_VERSION_SETTING = 'legend_version'
+
+
+def legend_version():
+    """Return string that changes whenever a Legend changes.
+
+    Used in cache keys of anything that is drawn with legends, by all
+    processes, so it is stored in a Setting. The django cache keeps it
+    for MAP_LEGEND_VERSION_CACHE_TIMEOUT seconds (default 60), which is
+    how long other processes can take to see a change.
+    """
+    version = cache.get(LEGEND_VERSION_KEY)
+    if version is None:
+        try:
+            version = Setting.objects.get(key=LEGEND_VERSION_SETTING).value
+        except Setting.DoesNotExist:
+            # No legend has been changed yet.
+            version = '0'
+        cache.set(LEGEND_VERSION_KEY, version,
+                  getattr(settings, 'MAP_LEGEND_VERSION_CACHE_TIMEOUT', 60))
+    return version
+
+
+def bump_legend_version():
+    """Store and return a new legend version."""
+    version = '%f' % time.time()
+    setting, created = Setting.objects.get_or_create(
+        key=LEGEND_VERSION_SETTING, defaults={'value': version})
+    if not created:
+        setting.value = version
+        setting.save()
+    cache.set(LEGEND_VERSION_KEY, version,
+              getattr(settings, 'MAP_LEGEND_VERSION_CACHE_TIMEOUT', 60))
+    return version
+
+
 class LegendManager(models.Manager):
     """Implements extra function 'find'
     """
@@ -1100,3 +1345,17 @@ def setting_post_save_delete(sender, **kwargs):
 
 post_save.connect(setting_post_save_delete, sender=Setting)
 post_delete.connect(setting_post_save_delete, sender=Setting)
+
+
+def legend_post_save_delete(sender, **kwargs):
+    """
+    Invalidates everything that is cached with the old legends.
+    """
+    logger.debug('Changed legend. Bumping legend version...')
+    bump_legend_version()
+
+
+post_save.connect(legend_post_save_delete, sender=Legend)
+post_delete.connect(legend_post_save_delete, sender=Legend)
+post_save.connect(legend_post_save_delete, sender=LegendPoint)
+post_delete.connect(legend_post_save_delete, sender=LegendPoint)
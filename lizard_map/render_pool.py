@@ -0,0 +1,87 @@
+"""
+Render matplotlib figures to png in worker processes.
+
+Rasterizing a graph is CPU bound and holds the GIL, so the graphs of a
+collage page are rendered one after another, while other requests in
+the same process wait. With MAP_GRAPH_RENDER_PROCESSES set, Graph.http_png()
+pickles its finished figure and lets a pool of processes (that have
+matplotlib imported already) draw it.
+
+Figures that can't be pickled, for instance because an adapter used a
+lambda as tick formatter, are rendered in the calling process.
+"""
+import cPickle as pickle
+import logging
+import multiprocessing
+import threading
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from django.conf import settings
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    """Import what rendering needs once per worker process."""
+    # Only what the pickled figures need: pyplot would set up a
+    # backend and global figure state that we don't use.
+    import matplotlib.backends.backend_agg
+    import matplotlib.dates
+    import matplotlib.figure
+    matplotlib  # Pyflakes...
+
+
+def render_pool():
+    """Return the per-process render pool, or None if disabled.
+
+    MAP_GRAPH_RENDER_PROCESSES is the number of processes (default 0:
+    render in the request thread).
+    """
+    global _pool
+    if _pool is None:
+        num_processes = getattr(settings, 'MAP_GRAPH_RENDER_PROCESSES', 0)
+        if not num_processes:
+            return None
+        with _pool_lock:
+            if _pool is None:
+                _pool = multiprocessing.Pool(num_processes,
+                                             initializer=_init_worker)
+    return _pool
+
+
+def figure_png(figure):
+    """Return png data of a matplotlib figure."""
+    canvas = FigureCanvas(figure)
+    buf = StringIO.StringIO()
+    canvas.print_png(buf)
+    return buf.getvalue()
+
+
+def _render_pickled(figure_pickle):
+    """Render a pickled figure, in a worker process."""
+    return figure_png(pickle.loads(figure_pickle))
+
+
+def render_png(figure):
+    """Return png data of figure, rendered in the pool if there is one.
+
+    Waits at most MAP_GRAPH_RENDER_TIMEOUT seconds (default 30) for a
+    worker, then raises multiprocessing.TimeoutError.
+    """
+    pool = render_pool()
+    if pool is None:
+        return figure_png(figure)
+    try:
+        figure_pickle = pickle.dumps(figure, pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        logger.debug("Can't pickle figure (%s), rendering it here", e)
+        return figure_png(figure)
+    return pool.apply_async(_render_pickled, (figure_pickle, )).get(
+        getattr(settings, 'MAP_GRAPH_RENDER_TIMEOUT', 30))
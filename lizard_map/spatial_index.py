@@ -0,0 +1,174 @@
+"""
+In-memory spatial index for adapter.search() implementations.
+
+Looping over all locations for every click is slow for layers with many
+locations. A SpatialIndex puts the locations in a uniform grid of cells,
+so a query only looks at the cells near the clicked point::
+
+    def search(self, x, y, radius=None):
+        index = self.spatial_index(
+            lambda: [(location.x, location.y, location)
+                     for location in self._locations()])
+        return [{'distance': distance, 'object': location, ...}
+                for distance, location in index.radius(x, y, radius)]
+
+Coordinates are google (EPSG:900913) coordinates, like the x, y of
+search().
+"""
+import math
+
+from django.conf import settings
+
+from lizard_map.utility import LRUCache
+
+
+class SpatialIndex(object):
+    """Uniform grid of points with radius and k-nearest queries."""
+
+    def __init__(self, records, cell_size=None):
+        """
+        - records: iterable of (x, y, item).
+        - cell_size: size of a grid cell in map units; by default
+          there are about four points per cell.
+        """
+        self.xs = []
+        self.ys = []
+        self.items = []
+        for x, y, item in records:
+            self.xs.append(float(x))
+            self.ys.append(float(y))
+            self.items.append(item)
+
+        if cell_size is None:
+            cell_size = 1.0
+            if self.xs:
+                size = max(max(self.xs) - min(self.xs),
+                           max(self.ys) - min(self.ys))
+                if size > 0:
+                    cell_size = 2 * size / math.sqrt(len(self.xs))
+        self.cell_size = cell_size
+
+        self._cells = {}
+        for index, (x, y) in enumerate(zip(self.xs, self.ys)):
+            self._cells.setdefault(self._cell(x, y), []).append(index)
+        if self._cells:
+            cells = self._cells.keys()
+            self._min_cell = (min([i for i, _ in cells]),
+                              min([j for _, j in cells]))
+            self._max_cell = (max([i for i, _ in cells]),
+                              max([j for _, j in cells]))
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _distances(self, x, y, indexes):
+        """Return list of (distance, index) for the given points."""
+        xs, ys = self.xs, self.ys
+        return [(math.hypot(xs[index] - x, ys[index] - y), index)
+                for index in indexes]
+
+    def radius(self, x, y, radius):
+        """Return sorted list of (distance, item) within radius of x, y."""
+        if not self._cells:
+            return []
+        min_i, min_j = self._cell(x - radius, y - radius)
+        max_i, max_j = self._cell(x + radius, y + radius)
+        min_i = max(min_i, self._min_cell[0])
+        min_j = max(min_j, self._min_cell[1])
+        max_i = min(max_i, self._max_cell[0])
+        max_j = min(max_j, self._max_cell[1])
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self._cells):
+            # Large radius: cheaper to look at all (non-empty) cells.
+            cells = [cell for cell in self._cells
+                     if min_i <= cell[0] <= max_i and
+                     min_j <= cell[1] <= max_j]
+        else:
+            cells = [(i, j)
+                     for i in range(min_i, max_i + 1)
+                     for j in range(min_j, max_j + 1)]
+        indexes = []
+        for cell in cells:
+            indexes.extend(self._cells.get(cell, ()))
+        found = [(distance, index)
+                 for distance, index in self._distances(x, y, indexes)
+                 if distance <= radius]
+        found.sort()
+        return [(distance, self.items[index]) for distance, index in found]
+
+    def nearest(self, x, y, k=1, max_distance=None):
+        """Return sorted list of the k nearest (distance, item) to x, y.
+
+        Optionally only items within max_distance.
+        """
+        if not self._cells:
+            return []
+        center_i, center_j = self._cell(x, y)
+        # Rings of cells around the center; after that all cells are seen.
+        max_ring = max(abs(center_i - self._min_cell[0]),
+                       abs(center_i - self._max_cell[0]),
+                       abs(center_j - self._min_cell[1]),
+                       abs(center_j - self._max_cell[1]))
+        found = []
+        ring = 0
+        while ring <= max_ring:
+            if ring == 0:
+                cells = [(center_i, center_j)]
+            else:
+                cells = []
+                for i in range(center_i - ring, center_i + ring + 1):
+                    cells.append((i, center_j - ring))
+                    cells.append((i, center_j + ring))
+                for j in range(center_j - ring + 1, center_j + ring):
+                    cells.append((center_i - ring, j))
+                    cells.append((center_i + ring, j))
+            indexes = []
+            for cell in cells:
+                indexes.extend(self._cells.get(cell, ()))
+            found.extend(self._distances(x, y, indexes))
+            # Everything outside the rings seen so far is at least this
+            # far away.
+            covered = ring * self.cell_size
+            if max_distance is not None and covered > max_distance:
+                break
+            if len(found) >= k:
+                found.sort()
+                del found[k:]
+                if found[-1][0] <= covered:
+                    break
+            ring += 1
+        found.sort()
+        if max_distance is not None:
+            found = [(distance, index) for distance, index in found
+                     if distance <= max_distance]
+        return [(distance, self.items[index])
+                for distance, index in found[:k]]
+
+
+_indexes = None
+
+
+def cached_index(key, records):
+    """Return SpatialIndex for key, built from records() if needed.
+
+    Indexes are kept per process in an LRU of MAP_SPATIAL_INDEX_CACHE_SIZE
+    (default 20) indexes. Key is typically (adapter class, layer json,
+    data version), see WorkspaceItemAdapter.spatial_index().
+
+    An index doesn't notice changes in the records: it is rebuilt after
+    MAP_SPATIAL_INDEX_TIMEOUT seconds (default 300, None keeps it until
+    it is evicted) or when the key changes.
+    """
+    global _indexes
+    if _indexes is None:
+        _indexes = LRUCache(
+            getattr(settings, 'MAP_SPATIAL_INDEX_CACHE_SIZE', 20),
+            ttl=getattr(settings, 'MAP_SPATIAL_INDEX_TIMEOUT', 300))
+    index = _indexes.get(key)
+    if index is None:
+        index = SpatialIndex(records())
+        _indexes.set(key, index)
+    return index
@@ -71,14 +71,16 @@ function open_popup(show_spinner) {
 // in use (26-09-2012)
 // main (single) popup
 function set_popup_content(data) {
-    var html, overlay, i;
+    var html, overlay, i, lazy;
     if (data !== null) {
+        // Tabs that the server didn't render yet: urls of their html.
+        lazy = (data.lazy) ? data.lazy : [];
         if (data instanceof jQuery) {
             $("#movable-dialog-content").empty().append(data);
         }
-        else if (data.html && data.html.length !== 0) {
+        else if (data.html && data.html.length + lazy.length !== 0) {
             // We got at least 1 result back.
-            if (data.html.length === 1) {
+            if (data.html.length === 1 && lazy.length === 0) {
                 // Just copy the contents directly into the target div.
                 $("#movable-dialog-content").html(data.html[0]);
                 // Have the graphs fetch their data.
@@ -90,6 +92,11 @@ function set_popup_content(data) {
                     html += '<li><a href="#popup-tab-' + (i + 1) + '">Tabblad ';
                     html += (i + 1) + '</a></li>';
                 }
+                for (i = 0; i < lazy.length; i += 1) {
+                    // jQuery UI Tabs loads these when they're selected.
+                    html += '<li><a href="' + lazy[i] + '">Tabblad ';
+                    html += (data.html.length + i + 1) + '</a></li>';
+                }
                 html += '</ul>';
                 for (i = 0; i < data.html.length; i += 1) {
                     html += '<div id="popup-tab-' + (i + 1) + '">';
@@ -112,6 +119,11 @@ function set_popup_content(data) {
                     create: function (event, ui) {
                         // Have the graphs fetch their data.
                         reloadGraphs();
+                    },
+                    load: function (event, ui) {
+                        // A lazy tab arrived.
+                        reloadGraphs();
+                        $(ui.panel).find(".add-snippet").snippetInteraction();
                     }
                 });
             }
@@ -1095,7 +1107,7 @@ function refreshWmsLayers() {
     ids_found = [];
     $lizard_map_wms = $("#lizard-map-wms");
     $(".workspace-wms-layer").each(function () {
-        var name, url, params, options, id, index;
+        var name, url, params, options, id, index, tile_url;
         // WMS id, different than workspace ids.
         id = $(this).attr("data-workspace-wms-id");
         ids_found.push(id);
@@ -1113,9 +1125,23 @@ function refreshWmsLayers() {
             delete options['reproject'];
         }
         index = parseInt($(this).attr("data-workspace-wms-index"));
+        tile_url = $(this).attr("data-workspace-wms-tile-url");
         if (wms_layers[id] === undefined) {
             // Create it.
-            var layer = new OpenLayers.Layer.WMS(name, url, params, options);
+            var layer;
+            if (tile_url) {
+                // Fixed tile grid, cacheable by the server and browser.
+                options = $.parseJSON(
+                    $(this).attr("data-workspace-wms-tile-options"));
+                options.maxExtent = OpenLayers.Bounds.fromArray(
+                    options.maxExtent);
+                options.tileSize = new OpenLayers.Size(
+                    options.tileSize, options.tileSize);
+                layer = new OpenLayers.Layer.XYZ(name, tile_url, options);
+            }
+            else {
+                layer = new OpenLayers.Layer.WMS(name, url, params, options);
+            }
             wms_layers[id] = layer;
             map.addLayer(layer);
             layer.setZIndex(1000 - index); // looks like passing this via options won't work properly
@@ -1495,7 +1521,13 @@ function reloadDynamicGraph($graph, callback, force) {
         // for flot graphs, grab the JSON data and call Flot
         if (graph_type == 'flot') {
             $.ajax({
-                url: url,
+                // Lines are reduced to what fits in the width, and the
+                // x values are sent as differences. Zooming in fetches
+                // the visible period again, see bindFlotRangeReload.
+                url: url + '&' + $.param({
+                    width: Math.max($graph.width(), 100),
+                    encoding: 'delta'
+                }),
                 method: 'GET',
                 dataType: 'json',
                 success: function (response) {
@@ -1507,6 +1539,9 @@ function reloadDynamicGraph($graph, callback, force) {
                     if ($graph.is(':hidden')) return;
 
                     var plot = flotGraphLoadData($graph, response);
+                    if (plot !== undefined) {
+                        bindFlotRangeReload(plot, url, flot_graph_data_url);
+                    }
                     on_drawn();
                     //bindPanZoomEvents($graph);
                 },
@@ -1577,6 +1612,29 @@ var MS_DAY = 24 * MS_HOUR;
 var MS_MONTH = 30 * MS_DAY;
 var MS_YEAR = 365 * MS_DAY;
 
+/**
+ * Convert series with separate x and y lists (see the encoding parameter
+ * of AdapterFlotGraphDataView) to series with flot's [x, y] pairs.
+ */
+function flotDecodeColumnar(data) {
+    var i, j, series, x;
+    for (i = 0; i < data.length; i += 1) {
+        series = data[i];
+        if (series.x !== undefined) {
+            series.data = [];
+            x = 0;
+            for (j = 0; j < series.x.length; j += 1) {
+                x = (series.x_delta) ? x + series.x[j] : series.x[j];
+                series.data.push([x, series.y[j]]);
+            }
+            delete series.x;
+            delete series.y;
+            delete series.x_delta;
+        }
+    }
+    return data;
+}
+
 /**
  * Draw the response data to a canvas in DOM element $graph using Flot.
  *
@@ -1584,7 +1642,7 @@ var MS_YEAR = 365 * MS_DAY;
  * @param {response} a dictionary containing graph data such as x/y values and labels
  */
 function flotGraphLoadData($container, response) {
-    var data = response.data;
+    var data = flotDecodeColumnar(response.data);
     if (data.length === 0) {
         $container.html('Geen gegevens beschikbaar.');
         return;
@@ -1728,6 +1786,7 @@ function flotGraphLoadData($container, response) {
         });
         plot.setupGrid();
         plot.draw();
+        $graph.trigger('flotxrangechange');
     });
     $c_plus.click(function () {
         plot.zoom({ amount: 2 });
@@ -1745,6 +1804,62 @@ function flotGraphLoadData($container, response) {
     return plot;
 }
 
+/**
+ * Reload the data of a flot graph when its x range changes.
+ *
+ * The server reduces the lines to what fits in the graph's width, so
+ * after zooming in the points of the visible period are fetched again.
+ * After a reset, the data of the whole period is fetched again.
+ *
+ * @param {plot} the flot plot
+ * @param {full_url} url of the data of the whole period
+ * @param {url} url of the data without period
+ */
+function bindFlotRangeReload(plot, full_url, url) {
+    var $placeholder = plot.getPlaceholder();
+    var timeout = null;
+    var request_number = 0;
+
+    var reload = function () {
+        var xaxis = plot.getAxes().xaxis;
+        var range_url = full_url;
+        if (xaxis.options.min !== null && xaxis.options.min !== undefined) {
+            range_url = url + '&' + $.param({
+                dt_start: moment.utc(xaxis.min).format('YYYY-MM-DDTHH:mm:ssZ'),
+                dt_end: moment.utc(xaxis.max).format('YYYY-MM-DDTHH:mm:ssZ')
+            });
+        }
+        request_number += 1;
+        var this_request = request_number;
+        $.ajax({
+            url: range_url + '&' + $.param({
+                width: Math.max($placeholder.width(), 100),
+                encoding: 'delta'
+            }),
+            method: 'GET',
+            dataType: 'json',
+            success: function (response) {
+                // Ignore responses to outdated requests.
+                if (this_request !== request_number) return;
+                if ($placeholder.is(':hidden') || !response.data) return;
+                plot.setData(flotDecodeColumnar(response.data));
+                plot.setupGrid();
+                plot.draw();
+            },
+            timeout: 20000
+        });
+    };
+
+    // Wait until the user stops zooming or panning.
+    var schedule = function () {
+        if (timeout) {
+            clearTimeout(timeout);
+        }
+        timeout = setTimeout(reload, 500);
+    };
+    $placeholder.bind('plotzoom plotpan flotxrangechange', schedule);
+}
+
 /**
 * Bind several flot graphs together. When navigating through one graph, the other graphs
 * should follow the zoom levels, and extent.
@@ -1763,6 +1878,7 @@ function panAndZoomOtherGraphs(plot) {
             if ($(this).is(':visible')) {
                 otherPlot.setupGrid();
                 otherPlot.draw();
+                $(this).trigger('flotxrangechange');
             }
         }
     });
@@ -4,8 +4,9 @@ from django.core.urlresolvers import reverse
 
 from lizard_map.daterange import current_start_end_dates
 #from lizard_map.models import Workspace
+from lizard_map.models import CUSTOM_LEGENDS
+from lizard_map.models import collage_items_statistics
 from lizard_map.utility import float_to_string
-from lizard_map.views import CUSTOM_LEGENDS
 
 register = template.Library()
 
@@ -87,9 +88,7 @@ def collage_item_statistics(request, collage_items):
     if not collage_items:
         return {}
     start_date, end_date = current_start_end_dates(request)
-    statistics = []
-    for collage_item in collage_items:
-        statistics.extend(collage_item.statistics(start_date, end_date))
+    statistics = collage_items_statistics(collage_items, start_date, end_date)
     return {
         'statistics': statistics,
         'collage_items': collage_items}
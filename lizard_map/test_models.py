@@ -4,14 +4,21 @@ import pkg_resources
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import User
 from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client
+import mock
 
+from lizard_map.adapter import adapter_entrypoint
 from lizard_map.models import CollageEdit
+from lizard_map.models import Legend
+from lizard_map.models import legend_version
+from lizard_map.models import Setting
 from lizard_map.models import WorkspaceEdit
 from lizard_map.models import WorkspaceEditItem
 from lizard_map.models import WorkspaceStorage
 from lizard_map.models import WorkspaceStorageItem
+from lizard_map.models import collage_items_statistics
 from lizard_map.testmodelapp.models import Extent
 from lizard_map.testmodelapp.models import Period
 from lizard_map.testmodelapp.models import UserSession
@@ -601,6 +608,52 @@ class WorkspaceItemTest(TestCase):
         # Make sure the code doesn't hang in the __unicode__ after a deletion.
         self.assertTrue(unicode(workspace_item))
 
+    def test_adapter_memoized(self):
+        workspace_item = WorkspaceEditItem(adapter_class='adapter_dummy',
+                                           adapter_layer_json='{}')
+        adapter = workspace_item.adapter
+        self.assertTrue(workspace_item.adapter is adapter)
+        workspace_item.adapter_layer_json = '{"bla": "yes"}'
+        self.assertFalse(workspace_item.adapter is adapter)
+        self.assertEquals(workspace_item.adapter.layer_arguments['bla'], 'yes')
+
+    def test_stateless_adapter_shared(self):
+        lizard_map.models._stateless_adapters = None
+        workspace_item1 = WorkspaceEditItem(adapter_class='adapter_dummy',
+                                            adapter_layer_json='{"a": 1}')
+        workspace_item2 = WorkspaceEditItem(adapter_class='adapter_dummy',
+                                            adapter_layer_json='{"a": 1}')
+        with mock.patch.object(lizard_map.layers.AdapterDummy,
+                               'is_stateless', True):
+            with mock.patch('lizard_map.models.adapter_entrypoint',
+                            wraps=adapter_entrypoint) as entrypoint:
+                adapter1 = workspace_item1.adapter
+                adapter2 = workspace_item2.adapter
+                self.assertEquals(entrypoint.call_count, 1)
+        # Copies, each bound to their own workspace item.
+        self.assertTrue(adapter1.workspace_item is workspace_item1)
+        self.assertTrue(adapter2.workspace_item is workspace_item2)
+
+    def test_extent_contains(self):
+        workspace_item = WorkspaceEditItem(
+            adapter_class='adapter_dummy',
+            adapter_layer_json='{"test": "extent_contains"}')
+        extent = {'west': 0.0, 'east': 10.0, 'south': 0.0, 'north': 10.0}
+        with mock.patch.object(lizard_map.layers.AdapterDummy, 'extent',
+                               return_value=extent) as adapter_extent:
+            self.assertTrue(workspace_item.extent_contains(5, 5))
+            self.assertFalse(workspace_item.extent_contains(12, 5))
+            self.assertTrue(workspace_item.extent_contains(12, 5, radius=3))
+            # The extent is cached.
+            self.assertEquals(adapter_extent.call_count, 1)
+
+    def test_extent_contains_unknown(self):
+        workspace_item = WorkspaceEditItem(
+            adapter_class='adapter_dummy',
+            adapter_layer_json='{"test": "extent_contains_unknown"}')
+        # AdapterDummy doesn't know its extent.
+        self.assertTrue(workspace_item.extent_contains(1e9, 1e9))
+
 
 class CollageTest(TestCase):
     def test_collage_item(self):
@@ -623,3 +676,51 @@ class CollageTest(TestCase):
         start_date = datetime.datetime(2011, 1, 1, 0, 0)
         end_date = datetime.datetime(2011, 1, 10, 0, 0)
         collage_item.statistics(start_date, end_date)
+
+
+class LegendVersionTest(TestCase):
+
+    def test_changes_on_save(self):
+        version = legend_version()
+        self.assertEqual(legend_version(), version)
+        legend = Legend(descriptor='test')
+        legend.save()
+        self.assertNotEqual(legend_version(), version)
+
+    def test_stored_in_database(self):
+        legend = Legend(descriptor='test')
+        legend.save()
+        version = legend_version()
+        # Other processes have their own cache.
+        cache.clear()
+        self.assertEqual(legend_version(), version)
+        self.assertEqual(Setting.objects.get(key='legend_version').value,
+                         version)
+
+    def test_stable_without_changes(self):
+        version = legend_version()
+        cache.clear()
+        self.assertEqual(legend_version(), version)
+
+
+class CollageItemsStatisticsTest(TestCase):
+
+    def _collage_item(self, name, statistics):
+        collage_item = mock.Mock(boundary_value=None, percentile_value=None)
+        collage_item.name = name
+        collage_item.statistics.side_effect = statistics
+        return collage_item
+
+    def test_order_and_errors(self):
+        def broken(start_date, end_date):
+            raise ValueError('broken')
+
+        collage_items = [
+            self._collage_item('a', lambda *args: [{'name': 'a'}]),
+            self._collage_item('b', broken),
+            self._collage_item('c', lambda *args: [{'name': 'c1'},
+                                                   {'name': 'c2'}])]
+        statistics = collage_items_statistics(collage_items, None, None)
+        self.assertEqual([row['name'] for row in statistics],
+                         ['a', 'b', 'c1', 'c2'])
+        self.assertEqual(statistics[1]['avg'], None)
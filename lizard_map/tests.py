@@ -1,5 +1,12 @@
 import datetime
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import urllib
 
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
@@ -7,16 +14,32 @@ from django.http import HttpRequest
 from django.test import TestCase
 from django.test.client import Client
 from django.utils import simplejson as json
+import mapnik
 import mock
+import pkg_resources
 import pytz
 import rest_framework
 
+from lizard_map import adapter
+from lizard_map import aggregation
 from lizard_map.adapter import Graph
 from lizard_map.adapter import parse_identifier_json
 from lizard_map import dateperiods
+from lizard_map.benchmarks import benchmark_page_render
+from lizard_map.benchmarks import compare_symbol_managers
+from lizard_map.disk_cache import DiskCache
+from lizard_map import downsampling
+from lizard_map.disk_cache import cache_key
+from lizard_map.management.commands import generate_symbols
+from lizard_map import mapnik_helper
+from lizard_map.mapnik_helper import MapPool
+from lizard_map import render_pool
+from lizard_map.tiles import TileGrid
+from lizard_map.utility import LRUCache
 from lizard_map.fields import Color
 from lizard_map.mapnik_helper import database_settings
 from lizard_map.models import Legend
+from lizard_map.models import LegendPoint
 from lizard_map.models import WorkspaceEdit
 from lizard_map.models import WorkspaceEditItem
 from lizard_map.operations import AnchestorRegistration
@@ -24,14 +47,19 @@ from lizard_map.operations import CycleError
 from lizard_map.operations import named_list
 from lizard_map.operations import tree_from_list
 from lizard_map.operations import unique_list
+from lizard_map.spatial_index import SpatialIndex
+from lizard_map.symbol_manager import SymbolManager
 from lizard_map.utility import float_to_string
 from lizard_map.utility import short_string
+from lizard_map import workers
 from lizard_map.workspace import WorkspaceItemAdapter
 from lizard_map.templatetags import workspaces
 import lizard_map.admin
 import lizard_map.coordinates
 import lizard_map.layers
 import lizard_map.models
+import lizard_map.spatial_index
+import lizard_map.tiles
 import lizard_map.urls
 import lizard_map.views
 
@@ -113,6 +141,14 @@ class ViewsTest(TestCase):
             {'top': '6964942', 'right': '1254790',
              'left': '-14675', 'bottom': '6668977'})
 
+    def test_benchmark_page_render(self):
+        num_workspaces = WorkspaceEdit.objects.count()
+        legacy_seconds, current_seconds = benchmark_page_render(
+            num_items=2, num_requests=1)
+        self.assertTrue(legacy_seconds > 0 and current_seconds > 0)
+        # The benchmark's workspace is gone.
+        self.assertEqual(WorkspaceEdit.objects.count(), num_workspaces)
+
     def test_mixins(self):
         view = lizard_map.views.AppView()
 
@@ -396,6 +432,11 @@ class WorkspaceItemAdapterTest(TestCase):
     def test_smoke(self):
         self.assertTrue(self.adapter)
 
+    def test_images_not_cached_by_default(self):
+        self.assertEqual(self.adapter.image_data_version(
+                [{'id': 1}], datetime.datetime(2012, 1, 1),
+                datetime.datetime(2012, 2, 1)), None)
+
     def test_line_styles(self):
         identifiers = [{str(i): 'b'} for i in range(10)]
         line_styles = self.adapter.line_styles(identifiers)
@@ -426,6 +467,23 @@ class WorkspaceItemAdapterTest(TestCase):
         self.assertTrue(aggregated_values['percentile'] >= 5.0)
         self.assertTrue(aggregated_values['percentile'] <= 6.0)
 
+    def test_value_aggregate_periods_default(self):
+        day = datetime.timedelta(days=1)
+        start_date = datetime.datetime(2010, 1, 1)
+        self.adapter.values = mock.Mock(return_value=[
+                {'datetime': start_date + i * day, 'value': float(i)}
+                for i in range(10)])
+        self.adapter.aggregate_from_values = True
+        periods = [(start_date, start_date + 4 * day),
+                   (start_date + 5 * day, start_date + 9 * day),
+                   (start_date + 20 * day, start_date + 30 * day)]
+        rows = self.adapter.value_aggregate_periods(
+            {}, {'min': None, 'max': None, 'count_gte': 2}, periods)
+        self.assertEqual(self.adapter.values.call_count, 1)
+        self.assertEqual(rows, [{'min': 0.0, 'max': 4.0, 'count_gte': 3},
+                                {'min': 5.0, 'max': 9.0, 'count_gte': 5},
+                                {'min': None, 'max': None, 'count_gte': 0}])
+
     def test_symbol_url(self):
         self.assertTrue(self.adapter.symbol_url())
 
@@ -433,6 +491,25 @@ class WorkspaceItemAdapterTest(TestCase):
         identifiers = {}
         self.assertTrue(self.adapter.html_default(identifiers=identifiers))
 
+    def test_html_default_location_once(self):
+        self.adapter.workspace_mixin_item.adapter_class = 'adapter_dummy'
+        self.adapter.location = mock.Mock(return_value={'name': 'name'})
+        self.adapter.html_default(identifiers=[{'id': 1}, {'id': 2}])
+        # Title and collage item of the first identifier share a lookup.
+        self.assertEqual(self.adapter.location.call_count, 2)
+
+    def test_html_default_cached(self):
+        self.adapter.workspace_mixin_item.adapter_class = 'adapter_dummy'
+        self.adapter.location = mock.Mock(return_value={'name': 'name'})
+        with self.settings(MAP_HTML_CACHE_TIMEOUT=60):
+            html = self.adapter.html_default(identifiers=[{'id': 3}])
+            self.assertEqual(
+                self.adapter.html_default(identifiers=[{'id': 3}]), html)
+        self.assertEqual(self.adapter.location.call_count, 1)
+
+    def test_html_cache_key_disabled(self):
+        self.assertEqual(self.adapter.html_cache_key([{'id': 3}]), None)
+
     def test_legend_object_default(self):
         self.adapter.legend_object_default('no_name')
 
@@ -989,3 +1066,761 @@ class ViewStateServiceTest(unittest.TestCase):
                 'dt_end': str(date2)}
         response = client.put(url, data=data)
         self.assertEqual(response.status_code, 200)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = DiskCache(self.path, max_size=1000,
+                               check_interval=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('a', (1, 2)), cache_key('a', (1, 2)))
+        self.assertNotEqual(cache_key('a', (1, 2)), cache_key('a', (2, 1)))
+
+    def test_get_set(self):
+        key = cache_key('tile')
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.set(key, 'png data')
+        self.assertEqual(self.cache.get(key), 'png data')
+
+    def test_max_age(self):
+        key = cache_key('tile')
+        self.cache.set(key, 'png data')
+        old = time.time() - 100
+        os.utime(self.cache.filename(key), (old, old))
+        self.assertEqual(self.cache.get(key, max_age=50), None)
+        self.assertEqual(self.cache.get(key, max_age=150), 'png data')
+
+    def test_evict_least_recently_used(self):
+        keys = [cache_key(i) for i in range(3)]
+        for index, key in enumerate(keys[:2]):
+            self.cache.set(key, 'x' * 400)
+            used = time.time() - 100 + index
+            os.utime(self.cache.filename(key), (used, used))
+        # Third write brings us above max_size: the oldest one goes.
+        self.cache.set(keys[2], 'x' * 400)
+        self.assertEqual(self.cache.get(keys[0]), None)
+        self.assertTrue(self.cache.get(keys[1]))
+        self.assertTrue(self.cache.get(keys[2]))
+
+    def test_walks_only_when_needed(self):
+        with mock.patch.object(self.cache, '_evict',
+                               wraps=self.cache._evict) as walk:
+            for i in range(5):
+                self.cache.set(cache_key(i), 'x' * 100)
+            # Once to find the initial size.
+            self.assertEqual(walk.call_count, 1)
+            self.cache.set(cache_key(5), 'x' * 600)
+            self.assertEqual(walk.call_count, 2)
+        self.assertEqual(self.cache.get(cache_key(0)), None)
+        self.assertTrue(self.cache.get(cache_key(5)))
+
+
+class TileGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = TileGrid('test', 'EPSG:28992', (0.0, 0.0, 1024.0, 1024.0),
+                             tile_size=256, num_zoom_levels=4)
+
+    def test_resolution(self):
+        self.assertEqual(self.grid.resolution(0), 4.0)
+        self.assertEqual(self.grid.resolution(2), 1.0)
+        self.assertEqual(len(self.grid.resolutions()), 4)
+
+    def test_is_valid(self):
+        self.assertTrue(self.grid.is_valid(0, 0, 0))
+        self.assertTrue(self.grid.is_valid(2, 3, 3))
+        self.assertFalse(self.grid.is_valid(2, 4, 0))
+        self.assertFalse(self.grid.is_valid(4, 0, 0))
+
+    def test_bbox(self):
+        self.assertEqual(self.grid.bbox(0, 0, 0), (0.0, 0.0, 1024.0, 1024.0))
+        # y counts from the top.
+        self.assertEqual(self.grid.bbox(1, 1, 0),
+                         (512.0, 512.0, 1024.0, 1024.0))
+        self.assertEqual(self.grid.bbox(2, 0, 3), (0.0, 0.0, 256.0, 256.0))
+
+    def test_bbox_block(self):
+        self.assertEqual(self.grid.bbox(2, 0, 0, width=2, height=2),
+                         (0.0, 512.0, 512.0, 1024.0))
+
+
+class MetatileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = DiskCache(self.path, max_size=10 ** 6)
+        self.grid = TileGrid('test', 'EPSG:28992', (0.0, 0.0, 1024.0, 1024.0),
+                             tile_size=256, num_zoom_levels=4)
+        self.image = mock.Mock()
+        self.image.view.side_effect = lambda x, y, width, height: mock.Mock(
+            **{'tostring.return_value': 'png %d %d' % (x, y)})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def render(self, zoom, x, y):
+        with mock.patch('lizard_map.disk_cache.tile_cache',
+                        return_value=self.cache):
+            with mock.patch('lizard_map.views.render_workspace_item_image',
+                            return_value=self.image) as render:
+                png = lizard_map.views.cached_render_metatile(
+                    None, mock.Mock(), 'content', [], self.grid,
+                    zoom, x, y, 4)
+        return png, render
+
+    def tile_key(self, zoom, x, y):
+        # The key tile() uses, and sends as ETag.
+        return lizard_map.views.png_key(
+            'content', [], self.grid.bbox(zoom, x, y), 256, 256,
+            self.grid.srs)
+
+    def test_clipped_to_grid(self):
+        png, render = self.render(0, 0, 0)
+        self.assertEqual(png, 'png 0 0')
+        args = render.call_args[0]
+        self.assertEqual(args[3], self.grid.bbox(0, 0, 0))
+        self.assertEqual(args[4:6], (256, 256))
+
+        png, render = self.render(1, 1, 0)
+        self.assertEqual(png, 'png 256 0')
+        args = render.call_args[0]
+        self.assertEqual(args[3], self.grid.bbox(1, 0, 0, 2, 2))
+        self.assertEqual(args[4:6], (512, 512))
+
+    def test_siblings_cached_under_tile_key(self):
+        self.render(1, 1, 0)
+        for x in range(2):
+            for y in range(2):
+                self.assertEqual(self.cache.get(self.tile_key(1, x, y)),
+                                 'png %d %d' % (x * 256, y * 256))
+
+    def test_second_request_is_cache_hit(self):
+        self.render(1, 0, 0)
+        png, render = self.render(1, 0, 1)
+        self.assertEqual(png, 'png 0 256')
+        self.assertFalse(render.called)
+
+
+class TileViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = HttpRequest()
+        self.workspace_item = mock.Mock()
+        self.workspace_item.content_key.return_value = 'content'
+        self.workspace_item.adapter.is_animatable = False
+        self.workspace_item.adapter.allow_custom_legend = False
+
+    def tile(self, grid_name, zoom, x, y):
+        with mock.patch('lizard_map.views.wms_workspace'):
+            with mock.patch('lizard_map.views.get_object_or_404',
+                            return_value=self.workspace_item):
+                with mock.patch(
+                    'lizard_map.views.cached_render_workspace_item',
+                    return_value='png') as render:
+                    response = lizard_map.views.tile(
+                        self.request, '1', grid_name, zoom, x, y)
+        return response, render
+
+    def etag(self, zoom, x, y):
+        grid = lizard_map.tiles.GRIDS['google']
+        return '"%s"' % lizard_map.views.png_key(
+            'content', [], grid.bbox(zoom, x, y), 256, 256, grid.srs)
+
+    def test_outside_grid(self):
+        self.assertEqual(self.tile('google', '0', '1', '0')[0].status_code,
+                         404)
+        self.assertEqual(self.tile('google', '1', '0', '-1')[0].status_code,
+                         404)
+        self.assertEqual(self.tile('unknown', '0', '0', '0')[0].status_code,
+                         404)
+
+    def test_etag(self):
+        response, render = self.tile('google', '1', '1', '0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'png')
+        self.assertEqual(response['ETag'], self.etag(1, 1, 0))
+
+    def test_not_modified(self):
+        self.request.META['HTTP_IF_NONE_MATCH'] = self.etag(1, 1, 0)
+        response, render = self.tile('google', '1', '1', '0')
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(render.called)
+
+        self.request.META['HTTP_IF_NONE_MATCH'] = self.etag(1, 0, 0)
+        self.assertEqual(self.tile('google', '1', '1', '0')[0].status_code,
+                         200)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('b', 2), 2)
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertTrue('a' in lru)
+        self.assertFalse('b' in lru)
+        self.assertEqual(len(lru), 2)
+
+    def test_ttl(self):
+        lru = LRUCache(maxsize=2, ttl=0.1)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+        time.sleep(0.2)
+        self.assertEqual(lru.get('a'), None)
+
+
+class MapPoolTest(unittest.TestCase):
+
+    def test_checkout_checkin(self):
+        pool = MapPool(max_size=2, max_idle=1)
+        self.assertEqual(pool.checkout('key'), None)
+        pool.checkin('key', 'map1')
+        # Only max_idle maps are kept.
+        pool.checkin('key', 'map2')
+        self.assertEqual(pool.checkout('key'), 'map1')
+        self.assertEqual(pool.checkout('key'), None)
+
+    def test_max_age(self):
+        pool = MapPool(max_age=10)
+        pool.checkin('key', 'map1')
+        with mock.patch('lizard_map.utility.time.time',
+                        return_value=time.time() + 20):
+            self.assertEqual(pool.checkout('key'), None)
+
+
+class SymbolManagerVectorizedTest(unittest.TestCase):
+
+    def test_identical_to_per_pixel(self):
+        # Vectorized colorize/composite must give exactly the same
+        # icons as the original per-pixel loops.
+        _, _, different = compare_symbol_managers()
+        self.assertEqual(different, [])
+
+
+class SymbolManagerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generated_path = tempfile.mkdtemp()
+        self.symbol_manager = SymbolManager(
+            pkg_resources.resource_filename('lizard_map', 'icons'),
+            self.generated_path, keep_data=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.generated_path)
+
+    def test_disk_only_touched_once(self):
+        filename = self.symbol_manager.get_symbol_transformed('empty.png')
+        os.remove(os.path.join(self.generated_path, filename))
+        # The filename is remembered, the file is not generated again.
+        self.assertEqual(
+            self.symbol_manager.get_symbol_transformed('empty.png'),
+            filename)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.generated_path, filename)))
+
+    def test_get_symbol_data(self):
+        data = self.symbol_manager.get_symbol_data('empty.png')
+        self.assertTrue(data.startswith('\x89PNG'))
+        self.assertTrue(self.symbol_manager.get_symbol_data('empty.png')
+                        is data)
+
+    def test_get_sprite(self):
+        icon_styles = [{'icon': 'empty.png', 'color': (1.0, 0.0, 0.0, 1.0)},
+                       {'icon': 'empty.png', 'color': (0.0, 1.0, 0.0, 1.0)}]
+        filename, offsets = self.symbol_manager.get_sprite(icon_styles)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.generated_path, filename)))
+        self.assertEqual(len(offsets), 2)
+        x, y, width, height = offsets[1]
+        self.assertEqual((x, y), (0, offsets[0][3]))
+        self.assertEqual(
+            self.symbol_manager.get_sprite(icon_styles), (filename, offsets))
+        # Written via a temporary file, which is gone.
+        self.assertEqual(
+            [name for name in os.listdir(self.generated_path)
+             if name.startswith('tmp-')], [])
+
+
+class GenerateSymbolsTest(TestCase):
+
+    def setUp(self):
+        self.generated_path = tempfile.mkdtemp()
+        self.symbol_manager = SymbolManager(
+            lizard_map.models.ICON_ORIGINALS, self.generated_path)
+        patcher = mock.patch.object(
+            mapnik_helper, '_symbol_manager', self.symbol_manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.legend = LegendPoint(
+            descriptor='points',
+            default_color='00ff00',
+            min_color='ff0000',
+            max_color='0000ff',
+            too_low_color='111111',
+            too_high_color='999999',
+            steps=2)
+        self.legend.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.generated_path)
+
+    def generate(self):
+        # Like the command's handle(), without the worker processes.
+        return [generate_symbols.generate_symbol(symbol)
+                for symbol in generate_symbols.symbols()]
+
+    def test_generates_what_mapnik_style_requests(self):
+        results = self.generate()
+        self.assertTrue(results)
+        self.assertEqual(
+            [status for filename, status in results],
+            [generate_symbols.GENERATED] * len(results))
+        for filename, status in results:
+            self.assertTrue(os.path.exists(
+                os.path.join(self.generated_path, filename)))
+
+        with mock.patch('lizard_map.models.point_rule',
+                        return_value=mapnik.Rule()) as point_rule:
+            self.legend.mapnik_style()
+        requested = set(
+            mapnik_helper.symbol_filename(*args[:3])
+            for args, kwargs in point_rule.call_args_list)
+        self.assertEqual(
+            requested, set(filename for filename, status in results))
+
+    def test_second_run_skips(self):
+        first = self.generate()
+        second = self.generate()
+        self.assertEqual(
+            [filename for filename, status in second],
+            [filename for filename, status in first])
+        self.assertEqual(
+            [status for filename, status in second],
+            [generate_symbols.SKIPPED] * len(second))
+
+
+class AdapterRegistryTest(unittest.TestCase):
+
+    def tearDown(self):
+        adapter.reload_adapters()
+
+    def test_load_adapter_class(self):
+        self.assertTrue(adapter.load_adapter_class('adapter_dummy') is
+                        lizard_map.layers.AdapterDummy)
+        self.assertRaises(adapter.AdapterClassNotFoundError,
+                          adapter.load_adapter_class, 'nonexisting')
+
+    def test_scanned_once(self):
+        adapter.reload_adapters()
+        with mock.patch('pkg_resources.iter_entry_points',
+                        return_value=[]) as iter_entry_points:
+            adapter.adapter_class_names()
+            adapter.adapter_class_names()
+            self.assertEqual(iter_entry_points.call_count, 1)
+            adapter.reload_adapters()
+            adapter.adapter_class_names()
+            self.assertEqual(iter_entry_points.call_count, 2)
+
+
+class ConcurrentMapTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        results = workers.concurrent_map(lambda x: x * 2, [1, 2, 3])
+        self.assertEqual(results, [(2, None), (4, None), (6, None)])
+
+    def test_error(self):
+        results = workers.concurrent_map(lambda x: 1 / x, [1, 0])
+        self.assertEqual(results[0], (1, None))
+        self.assertTrue(isinstance(results[1][1], ZeroDivisionError))
+
+    def test_timeout(self):
+        results = workers.concurrent_map(
+            lambda x: time.sleep(x) or x, [0, 2], timeout=0.5)
+        self.assertEqual(results[0], (0, None))
+        self.assertTrue(isinstance(results[1][1], workers.WorkerTimeout))
+
+    @mock.patch.object(workers.settings, 'MAP_WORKER_THREADS', 1,
+                       create=True)
+    def test_timeout_per_item(self):
+        # With one thread, the second call only starts after the first.
+        results = workers.concurrent_map(
+            lambda x: time.sleep(x) or x, [0.3, 0.3], timeout=0.5,
+            per_item=True)
+        self.assertEqual(results, [(0.3, None), (0.3, None)])
+
+    @mock.patch.object(workers.settings, 'MAP_WORKER_THREADS', 1,
+                       create=True)
+    def test_timeout_per_item_hanging(self):
+        # A call that hangs doesn't keep the rest from running.
+        results = workers.concurrent_map(
+            lambda x: time.sleep(x) or x, [5, 0], timeout=0.2,
+            per_item=True)
+        self.assertTrue(isinstance(results[0][1], workers.WorkerTimeout))
+        self.assertEqual(results[1], (0, None))
+
+    def test_hanging_calls_dont_block_others(self):
+        event = threading.Event()
+        try:
+            results = workers.concurrent_map(
+                lambda x: event.wait(), range(20), timeout=0.1)
+            self.assertTrue(isinstance(results[0][1], workers.WorkerTimeout))
+            start = time.time()
+            results = workers.concurrent_map(lambda x: x, [1, 2], timeout=5)
+            self.assertEqual(results, [(1, None), (2, None)])
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            event.set()
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [(x * 10.0, y * 10.0, (x, y))
+                       for x in range(20) for y in range(20)]
+        self.index = SpatialIndex(self.points)
+
+    def brute_force(self, x, y):
+        return sorted([(math.hypot(px - x, py - y), item)
+                       for px, py, item in self.points])
+
+    def test_radius(self):
+        for x, y, radius in [(0, 0, 15), (55, 55, 30), (-100, 0, 10),
+                             (100, 100, 1000)]:
+            self.assertEqual(
+                self.index.radius(x, y, radius),
+                [(distance, item) for distance, item
+                 in self.brute_force(x, y) if distance <= radius])
+
+    def test_nearest(self):
+        for x, y in [(0, 0), (53, 57), (500, -300)]:
+            self.assertEqual(self.index.nearest(x, y, k=5),
+                             self.brute_force(x, y)[:5])
+        self.assertEqual(self.index.nearest(500, 500, max_distance=10), [])
+
+    def test_cached_index_expires(self):
+        lizard_map.spatial_index._indexes = None
+        try:
+            index = lizard_map.spatial_index.cached_index(
+                'key', lambda: self.points)
+            self.assertTrue(lizard_map.spatial_index.cached_index(
+                    'key', lambda: []) is index)
+            with mock.patch('lizard_map.utility.time.time',
+                            return_value=time.time() + 3600):
+                self.assertEqual(lizard_map.spatial_index.cached_index(
+                        'key', lambda: []).radius(0, 0, 10), [])
+        finally:
+            lizard_map.spatial_index._indexes = None
+
+    def test_empty(self):
+        index = SpatialIndex([])
+        self.assertEqual(index.radius(0, 0, 10), [])
+        self.assertEqual(index.nearest(0, 0), [])
+
+
+class HoverNameTest(unittest.TestCase):
+
+    def setUp(self):
+        lizard_map.views._hover_cache = None
+        workspace_item = mock.Mock(adapter_class='adapter_dummy',
+                                   adapter_layer_json='{}')
+        self.workspace = mock.Mock()
+        self.workspace.workspace_items.filter.return_value = [workspace_item]
+
+    def tearDown(self):
+        lizard_map.views._hover_cache = None
+
+    def test_cached_per_cell(self):
+        found = [{'distance': 2, 'name': 'far'},
+                 {'distance': 1, 'name': 'near'}]
+        with mock.patch('lizard_map.views.search',
+                        return_value=found) as search:
+            self.assertEqual(
+                lizard_map.views.hover_name(self.workspace, 1001, 1001, 100),
+                'near')
+            # A few pixels further: same cell.
+            lizard_map.views.hover_name(self.workspace, 1003, 1002, 100)
+            self.assertEqual(search.call_count, 1)
+            lizard_map.views.hover_name(self.workspace, 1500, 1001, 100)
+            self.assertEqual(search.call_count, 2)
+
+    def test_nothing_found(self):
+        with mock.patch('lizard_map.views.search',
+                        return_value=[]) as search:
+            self.assertEqual(
+                lizard_map.views.hover_name(self.workspace, 0, 0, 100), None)
+            lizard_map.views.hover_name(self.workspace, 0, 0, 100)
+            self.assertEqual(search.call_count, 1)
+
+
+class PopupJsonTest(TestCase):
+
+    def _found(self, num_items):
+        found = []
+        for i in range(num_items):
+            workspace_item = mock.Mock(id=i + 1)
+            workspace_item.adapter.html.return_value = 'html %d' % i
+            found.append({'workspace_item': workspace_item,
+                          'identifier': {'id': i},
+                          'distance': i})
+        return found
+
+    def test_only_shown_tabs_rendered(self):
+        found = self._found(5)
+        with self.settings(POPUP_MAX_TABS=2):
+            response = lizard_map.views.popup_json(found)
+        result = json.loads(response.content)
+        self.assertEqual(result['html'], ['html 0', 'html 1'])
+        self.assertEqual(len(result['lazy']), 3)
+        self.assertFalse(found[2]['workspace_item'].adapter.html.called)
+        self.assertTrue('workspace_item_id=3' in result['lazy'][0])
+
+    def test_timed_out_tabs_lazy_in_order(self):
+        found = self._found(4)
+        timeout = (None, workers.WorkerTimeout())
+        with mock.patch('lizard_map.workers.concurrent_map',
+                        return_value=[timeout, timeout, ('html 2', None)]):
+            with self.settings(POPUP_MAX_TABS=3):
+                response = lizard_map.views.popup_json(found)
+        result = json.loads(response.content)
+        self.assertEqual(result['html'], ['html 2'])
+        self.assertEqual(len(result['lazy']), 3)
+        for url, workspace_item_id in zip(result['lazy'], [1, 2, 4]):
+            self.assertTrue(
+                'workspace_item_id=%d' % workspace_item_id in url)
+
+    def test_no_lazy_tabs(self):
+        response = lizard_map.views.popup_json(self._found(1))
+        result = json.loads(response.content)
+        self.assertEqual(result['html'], ['html 0'])
+        self.assertFalse('lazy' in result)
+
+
+class AggregationTest(unittest.TestCase):
+
+    def test_missing_values(self):
+        result = aggregation.aggregate(
+            [3.0, None, float('nan'), 1.0, 2.0],
+            {'min': None, 'max': None, 'avg': None, 'count_lt': 2,
+             'count_gte': 2, 'percentile': 50, 'unknown': None})
+        self.assertEqual(result, {'min': 1.0, 'max': 3.0, 'avg': 2.0,
+                                  'count_lt': 1, 'count_gte': 2,
+                                  'percentile': 2.0, 'unknown': None})
+
+    def test_empty(self):
+        result = aggregation.aggregate(
+            [], {'min': None, 'avg': None, 'count_lt': 2, 'percentile': 50})
+        self.assertEqual(result, {'min': None, 'avg': None, 'count_lt': 0,
+                                  'percentile': None})
+
+    def test_interpolated_percentile(self):
+        values = aggregation.sorted_values([10, 20, 30, 40])
+        self.assertEqual(aggregation.percentile(values, 0), 10.0)
+        self.assertEqual(aggregation.percentile(values, 50), 25.0)
+        self.assertEqual(aggregation.percentile(values, 100), 40.0)
+
+    def test_register_aggregate(self):
+        aggregation.register_aggregate(
+            'test_sum', lambda values, argument: float(values.sum()))
+        self.assertEqual(
+            aggregation.aggregate([1, 2], {'test_sum': None}),
+            {'test_sum': 3.0})
+
+
+class CsvChunksTest(unittest.TestCase):
+
+    def test_chunks(self):
+        rows = (['row %d' % i, i] for i in range(10000))
+        with mock.patch('lizard_map.views.CSV_CHUNK_SIZE', 1000):
+            chunks = list(lizard_map.views.csv_chunks(rows))
+        self.assertTrue(len(chunks) > 1)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), 10000)
+        self.assertEqual(lines[-1], 'row 9999,9999')
+
+    def test_empty(self):
+        self.assertEqual(list(lizard_map.views.csv_chunks([])), [])
+
+
+class FlotDataTest(unittest.TestCase):
+
+    def test_mk_js_timestamps(self):
+        start = datetime.datetime(2011, 3, 20)
+        datetimes = [start + i * datetime.timedelta(minutes=17)
+                     for i in range(2000)]
+        datetimes.append(datetime.date(2011, 7, 1))
+        datetimes.append(pytz.utc.localize(start))
+        self.assertEqual(
+            adapter.mk_js_timestamps(datetimes).tolist(),
+            [adapter.mk_js_timestamp(value) for value in datetimes])
+
+    def test_min_max_downsample(self):
+        xs = range(1000)
+        ys = [float(x % 10) for x in xs]
+        ys[500] = 100.0
+        ys[700] = float('nan')
+        down_xs, down_ys = downsampling.min_max_downsample(xs, ys, 50)
+        self.assertTrue(len(down_xs) <= 100)
+        self.assertEqual(max(down_ys), 100.0)
+        self.assertEqual(min(down_ys), 0.0)
+        self.assertEqual(sorted(down_xs), list(down_xs))
+
+    def test_downsample_flot_data(self):
+        flot_data = [
+            {'data': [(x, x) for x in range(1000)], 'lines': {'show': True}},
+            {'data': [(x, x) for x in range(1000)], 'bars': {'show': True}}]
+        result = adapter.downsample_flot_data(flot_data, 100)
+        self.assertTrue(len(result[0]['data']) <= 200)
+        self.assertEqual(len(result[1]['data']), 1000)
+
+    def test_columnar_flot_data(self):
+        flot_data = [{'label': 'a',
+                      'data': [(1000, 1.0), (2000, None), (4000, 3.0)]}]
+        self.assertEqual(
+            adapter.columnar_flot_data(flot_data, delta=True),
+            [{'label': 'a', 'x': [1000, 1000, 2000], 'x_delta': True,
+              'y': [1.0, None, 3.0]}])
+
+    def test_flot_data_since(self):
+        flot_data = [{'label': 'a', 'data': [(1000, 1), (2000, 2)]}]
+        self.assertEqual(adapter.flot_data_since(flot_data, 1000),
+                         [{'label': 'a', 'data': [(2000, 2)]}])
+        # The original is untouched.
+        self.assertEqual(len(flot_data[0]['data']), 2)
+
+
+class FlotGraphDataViewTest(TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.adapter.flot_graph_data.return_value = {
+            'data': [{'label': 'a', 'data': [[1000, 1], [2000, 2]]}]}
+        self.url = reverse('lizard_map_adapter_flot_graph_data',
+                           kwargs={'adapter_class': 'adapter_dummy'})
+
+    def get(self, extra_parameters='', **extra):
+        parameters = {'identifier': '{"id": 1}',
+                      'dt_start': '2012-01-01T00:00:00Z',
+                      'dt_end': '2012-02-01T00:00:00Z'}
+        with mock.patch('lizard_map.views.adapter_entrypoint',
+                        return_value=self.adapter):
+            return self.client.get(
+                self.url + '?' + urllib.urlencode(parameters) +
+                extra_parameters, **extra)
+
+    def test_since(self):
+        response = self.get('&since=1000')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['since'], 1000)
+        self.assertEqual(result['data'],
+                         [{'label': 'a', 'data': [[2000, 2]]}])
+
+    def test_invalid_since(self):
+        self.assertEqual(self.get('&since=yesterday').status_code, 400)
+        self.assertEqual(self.get('&since=nan').status_code, 400)
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(
+            self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.adapter.flot_graph_data.return_value['data'][0]['data'].append(
+            [3000, 3])
+        self.assertEqual(
+            self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class GraphKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.view = lizard_map.views.AdapterImageView()
+        self.view.request = mock.Mock(GET={})
+        self.adapter = mock.Mock()
+        self.adapter.image_data_version.return_value = 'v1'
+
+    def graph_key(self, **kwargs):
+        arguments = {'identifiers': [{'id': 1}],
+                     'start_date': datetime.datetime(2012, 1, 1),
+                     'end_date': datetime.datetime(2012, 2, 1),
+                     'width': 400, 'height': 300, 'layout_extra': {}}
+        arguments.update(kwargs)
+        with mock.patch('lizard_map.disk_cache.graph_cache'):
+            return self.view.graph_key(self.adapter, 'adapter_dummy',
+                                       **arguments)
+
+    def test_key(self):
+        key = self.graph_key()
+        self.assertEqual(key, self.graph_key())
+        self.assertNotEqual(key, self.graph_key(width=500))
+        self.adapter.image_data_version.return_value = 'v2'
+        self.assertNotEqual(key, self.graph_key())
+
+    def test_not_cached(self):
+        self.adapter.image_data_version.return_value = None
+        self.assertEqual(self.graph_key(), None)
+
+
+class RenderPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = Graph(datetime.datetime(2012, 1, 1),
+                           datetime.datetime(2012, 2, 1))
+        self.graph.axes.plot(
+            [datetime.datetime(2012, 1, i) for i in range(1, 31)], range(30))
+
+    def test_pickled_figure_renders_the_same(self):
+        figure_pickle = render_pool.pickle.dumps(self.graph.figure, 2)
+        self.assertEqual(render_pool._render_pickled(figure_pickle),
+                         render_pool.figure_png(self.graph.figure))
+
+    def test_without_pool(self):
+        with mock.patch('lizard_map.render_pool.render_pool',
+                        return_value=None):
+            png = render_pool.render_png(self.graph.figure)
+        self.assertTrue(png.startswith('\x89PNG'))
+
+
+class GraphReducePointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2012, 1, 1)
+        self.graph = Graph(self.start, datetime.datetime(2013, 1, 1))
+
+    def test_date_numbers(self):
+        datetimes = [self.start + datetime.timedelta(minutes=7 * i)
+                     for i in range(100)]
+        datetimes.append(pytz.utc.localize(self.start))
+        datetimes.append(datetime.date(2012, 5, 1))
+        self.assertEqual(adapter.date_numbers(datetimes).tolist(),
+                         list(adapter.date2num(datetimes)))
+
+    def test_peaks_remain(self):
+        xvalues = [self.start + datetime.timedelta(hours=i)
+                   for i in range(8000)]
+        yvalues = [float(i % 5) for i in range(8000)]
+        yvalues[4321] = 100.0
+        lines = self.graph.plot(xvalues, yvalues)
+        ydata = lines[0].get_ydata()
+        self.assertTrue(len(ydata) < 1000)
+        self.assertEqual(max(ydata), 100.0)
+        self.assertEqual(min(ydata), 0.0)
+
+    def test_small_series_unchanged(self):
+        lines = self.graph.plot(range(10), range(10))
+        self.assertEqual(list(lines[0].get_ydata()), range(10))
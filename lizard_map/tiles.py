@@ -0,0 +1,80 @@
+"""
+Tile grids for serving workspace items as fixed z/x/y tiles.
+
+Tiles are numbered from the top left corner of the grid: x grows to the
+east, y grows to the south (like google maps and OpenLayers.Layer.XYZ).
+"""
+
+TILE_SIZE = 256
+NUM_ZOOM_LEVELS = 20
+
+
+class TileGrid(object):
+    """Square grid of tiles, each zoom level halving the resolution."""
+
+    def __init__(self, name, srs, extent, tile_size=TILE_SIZE,
+                 num_zoom_levels=NUM_ZOOM_LEVELS):
+        """
+        - extent: (xmin, ymin, xmax, ymax) of the single tile at zoom 0.
+        """
+        self.name = name
+        self.srs = srs
+        self.extent = extent
+        self.tile_size = tile_size
+        self.num_zoom_levels = num_zoom_levels
+
+    def resolution(self, zoom):
+        """Return size of a pixel in map units."""
+        return (self.extent[2] - self.extent[0]) / self.tile_size / 2 ** zoom
+
+    def resolutions(self):
+        return [self.resolution(zoom)
+                for zoom in range(self.num_zoom_levels)]
+
+    def is_valid(self, zoom, x, y):
+        """Return whether tile zoom/x/y exists in this grid."""
+        if not 0 <= zoom < self.num_zoom_levels:
+            return False
+        num_tiles = 2 ** zoom
+        return 0 <= x < num_tiles and 0 <= y < num_tiles
+
+    def bbox(self, zoom, x, y, width=1, height=1):
+        """Return (xmin, ymin, xmax, ymax) of tile zoom/x/y.
+
+        With width and height, return the bbox of a block of width x
+        height tiles with zoom/x/y in the top left corner.
+        """
+        tile_extent = self.resolution(zoom) * self.tile_size
+        xmin = self.extent[0] + x * tile_extent
+        ymax = self.extent[3] - y * tile_extent
+        return (xmin, ymax - height * tile_extent,
+                xmin + width * tile_extent, ymax)
+
+    def openlayers_options(self):
+        """Return options for an OpenLayers.Layer.XYZ on this grid.
+
+        By providing the server resolutions, OpenLayers finds the right
+        zoom level regardless of the resolutions of the map itself.
+        """
+        return {'maxExtent': list(self.extent),
+                'serverResolutions': self.resolutions(),
+                'tileSize': self.tile_size}
+
+
+GOOGLE_EXTENT = 20037508.342789244
+
+GRIDS = {
+    'google': TileGrid(
+        'google', 'EPSG:900913',
+        (-GOOGLE_EXTENT, -GOOGLE_EXTENT, GOOGLE_EXTENT, GOOGLE_EXTENT)),
+    # The Dutch national tiling scheme, also used by PDOK.
+    'rd': TileGrid(
+        'rd', 'EPSG:28992',
+        (-285401.92, 22598.08, 595401.92, 903401.92)),
+    }
+
+srs_to_grid = {
+    'EPSG:900913': GRIDS['google'],
+    'EPSG:3857': GRIDS['google'],
+    'EPSG:28992': GRIDS['rd'],
+    }
@@ -29,6 +29,9 @@ urlpatterns = patterns(
     url(r'^myworkspace/wms/(?P<workspace_item_id>\d+)/$',
         'lizard_map.views.wms',
         name="lizard_map_workspace_edit_wms"),
+    url(r'^myworkspace/tile/(?P<workspace_item_id>\d+)/(?P<grid_name>\w+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+).png$',
+        'lizard_map.views.tile',
+        name="lizard_map_workspace_edit_tile"),
     url(r'^myworkspace/empty/$',
         lizard_map.views.WorkspaceEmptyView.as_view(),
         name="lizard_map_workspace_empty"),
@@ -48,6 +51,12 @@ urlpatterns = patterns(
     url(r'^workspacestorageitem/extent/$',
         'lizard_map.views.saved_workspace_item_extent',
         name="lizard_map_workspace_storage_item_extent"),
+    url(r'^workspaceitem/popup/$',
+        'lizard_map.views.workspace_item_popup',
+        name="lizard_map_workspace_item_popup"),
+    url(r'^workspacestorageitem/popup/$',
+        'lizard_map.views.saved_workspace_item_popup',
+        name="lizard_map_workspace_storage_item_popup"),
 
     url(r'^mycollage/$',
         lizard_map.views.CollageDetailView.as_view(),
@@ -99,6 +108,9 @@ urlpatterns = patterns(
     url(r'^workspace/(?P<workspace_storage_id>\d+)/(?P<workspace_item_id>\d+)/wms/$',
         'lizard_map.views.wms',
         name="lizard_map_workspace_storage_wms"),
+    url(r'^workspace/(?P<workspace_storage_id>\d+)/(?P<workspace_item_id>\d+)/tile/(?P<grid_name>\w+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+).png$',
+        'lizard_map.views.tile',
+        name="lizard_map_workspace_storage_tile"),
     url(r'^workspace/(?P<workspace_storage_id>\d+)/search_coordinates/',
         'lizard_map.views.search_coordinates',
         name="lizard_map.search_coordinates"),
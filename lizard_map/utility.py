@@ -1,4 +1,7 @@
 """Small utility functions"""
+import threading
+import time
+from collections import OrderedDict
 
 
 def short_string(value, length):
@@ -43,3 +46,55 @@ def analyze_http_user_agent(http_user_agent):
         device = 'iPad'
 
     return {'device': device}
+
+
+class LRUCache(object):
+    """Thread safe in-memory dict of at most maxsize items.
+
+    When full, the least recently used item is removed. With ttl,
+    items expire ttl seconds after they were set.
+    """
+
+    def __init__(self, maxsize=100, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key: (value, expiry time or None)
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Re-insert to mark it as most recently used.
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -4,25 +4,38 @@ except ImportError:
     import StringIO
 import csv
 import datetime
+import hashlib
 import logging
 import re
+import threading
+import urllib
 import urllib2
 from dateutil import parser as date_parser
 
 from PIL import Image
 from django import forms
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest, HttpResponseNotFound
+from django.http import HttpResponseNotModified
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams an HttpResponse with an iterator as content.
+    StreamingHttpResponse = HttpResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.utils import simplejson as json
+from django.utils import translation
 from django.utils.translation import ugettext as _
+from django.utils.cache import add_never_cache_headers
+from django.utils.cache import patch_cache_control
 from django.views.decorators.cache import never_cache
 from django.views.generic.base import TemplateView
 from django.views.generic.base import View
@@ -39,8 +52,16 @@ import iso8601
 import mapnik
 
 from lizard_map import coordinates
+from lizard_map import disk_cache
+from lizard_map import mapnik_helper
+from lizard_map import tiles
+from lizard_map import workers
 from lizard_map.adapter import adapter_entrypoint
 from lizard_map.adapter import adapter_layer_arguments
+from lizard_map.adapter import columnar_flot_data
+from lizard_map.adapter import downsample_flot_data
+from lizard_map.adapter import flot_data_since
+from lizard_map.adapter import mk_js_timestamp
 from lizard_map.adapter import parse_identifier_json
 from lizard_map.coordinates import DEFAULT_OSM_LAYER_URL
 from lizard_map.coordinates import transform_point
@@ -60,15 +81,17 @@ from lizard_map.forms import WorkspaceSaveForm
 from lizard_map.lizard_widgets import Legend
 from lizard_map.models import BackgroundMap
 from lizard_map.models import CollageEdit
+from lizard_map.models import CUSTOM_LEGENDS
 from lizard_map.models import CollageEditItem
 from lizard_map.models import Setting
 from lizard_map.models import WorkspaceEdit
 from lizard_map.models import WorkspaceEditItem
 from lizard_map.models import WorkspaceStorage
 from lizard_map.models import WorkspaceStorageItem
+from lizard_map.models import collage_items_statistics
+from lizard_map.utility import LRUCache
 from lizard_map.utility import analyze_http_user_agent
 
-CUSTOM_LEGENDS = 'custom_legends'
 MAP_LOCATION = 'map_location'
 MAP_BASE_LAYER = 'map_base_layer'  # The selected base layer
 TIME_BETWEEN_VIDEO_POPUP = datetime.timedelta(days=1)
@@ -847,10 +870,15 @@ def popup_json(found, popup_id=None, hide_add_snippet=False, request=None):
               'y': y_found,
               'html': result_html,
               'big': big_popup,
+              'lazy': lazy_urls,
               }
+
+    'lazy' is optional: a list of workspace_item_popup urls, one per tab
+    that isn't in 'html' (beyond POPUP_MAX_TABS, or slower than
+    MAP_POPUP_TIMEOUT). Each returns the html of its tab when the tab
+    is opened.
     """
 
-    html = {}
     # x_found = None
     # y_found = None
 
@@ -874,13 +902,19 @@ def popup_json(found, popup_id=None, hide_add_snippet=False, request=None):
     else:
         big_popup = False
 
-    # Now display them.
-    for key, display_group in display_groups.items():
+    popup_max_tabs = Setting.get('popup_max_tabs', None)
+    if popup_max_tabs is None:
+        popup_max_tabs = getattr(settings, 'POPUP_MAX_TABS', 3)
+    else:
+        popup_max_tabs = int(popup_max_tabs)
+
+    # Collect what to display, in display order.
+    groups = []
+    for key in display_group_order:
+        display_group = display_groups[key]
         # There MUST be at least one item in the group
         workspace_item = display_group[0]['workspace_item']
 
-        add_snippet = True
-
         try:
             identifiers = [display_object['identifier']
                            for display_object in display_group]
@@ -891,29 +925,51 @@ def popup_json(found, popup_id=None, hide_add_snippet=False, request=None):
             identifiers = None
         if identifiers is None:
             continue
+        groups.append((workspace_item, identifiers))
+
+    # Only render the tabs that are shown, the others are loaded when
+    # they're clicked (see workspace_item_popup).
+    shown_groups = groups[:popup_max_tabs]
+    lazy_groups = groups[popup_max_tabs:]
 
+    # Get the adapters here: it can delete broken workspace items.
+    adapters = [group[0].adapter for group in shown_groups]
+
+    def render_group(group_index):
+        workspace_item, identifiers = shown_groups[group_index]
         # Passing the request object as a layout_option is a bit of a hack,
         # but for some use cases we really need access to it in the html()
         # method of a WorkspaceItemAdapter, which unfortunately is
         # lacking a **kwargs at this moment.
-
-        html_per_workspace_item = workspace_item.adapter.html(
+        return adapters[group_index].html(
             identifiers=identifiers,
-            layout_options={'add_snippet': add_snippet,
+            layout_options={'add_snippet': True,
                             'legend': True,
                             'request': request},
             )
 
-        # if 'google_coords' in display_object:
-        #     x_found, y_found = display_object['google_coords']
-        html[key] = html_per_workspace_item
-
-    popup_max_tabs = Setting.get('popup_max_tabs', None)
-    if popup_max_tabs is None:
-        popup_max_tabs = getattr(settings, 'POPUP_MAX_TABS', 3)
+    group_indexes = range(len(shown_groups))
+    if len(shown_groups) > 1:
+        rendered = workers.concurrent_map(
+            render_group, group_indexes,
+            timeout=getattr(settings, 'MAP_POPUP_TIMEOUT', 10))
     else:
-        popup_max_tabs = int(popup_max_tabs)
-    result_html = [html[key] for key in display_group_order][:popup_max_tabs]
+        rendered = [(render_group(group_index), None)
+                    for group_index in group_indexes]
+
+    result_html = []
+    timed_out_groups = []
+    for group, (html_per_workspace_item, error) in zip(shown_groups,
+                                                       rendered):
+        if isinstance(error, workers.WorkerTimeout):
+            logger.warning("Popup for %s is too slow, loading it lazily",
+                           group[0])
+            timed_out_groups.append(group)
+        elif error is not None:
+            logger.error("Error rendering popup for %s: %r", group[0], error)
+        else:
+            result_html.append(html_per_workspace_item)
+    lazy_groups = timed_out_groups + lazy_groups
 
     if popup_id is None:
         popup_id = 'popup-id'
@@ -923,9 +979,54 @@ def popup_json(found, popup_id=None, hide_add_snippet=False, request=None):
               'html': result_html,
               'big': big_popup,
               }
+    if lazy_groups:
+        result['lazy'] = [workspace_item_popup_url(*group)
+                          for group in lazy_groups]
     return HttpResponse(json.dumps(result))
 
 
+def workspace_item_popup_url(workspace_item, identifiers):
+    """Return url of workspace_item_popup() for a popup tab."""
+    if isinstance(workspace_item, WorkspaceStorageItem):
+        url_name = 'lizard_map_workspace_storage_item_popup'
+    else:
+        url_name = 'lizard_map_workspace_item_popup'
+    return '%s?%s' % (
+        reverse(url_name),
+        urllib.urlencode({'workspace_item_id': workspace_item.id,
+                          'identifiers': json.dumps(identifiers)}))
+
+
+def workspace_item_popup(request, item_class=WorkspaceEditItem):
+    """Return popup html of a workspace item for the given identifiers.
+
+    Used for the popup tabs that popup_json() doesn't render right away.
+
+    With ``item_class`` we can customize it in
+    ``saved_workspace_item_popup()``.
+
+    """
+    workspace_item_id = request.GET['workspace_item_id']
+    workspace_item = get_object_or_404(item_class, pk=workspace_item_id)
+    try:
+        identifiers = [
+            parse_identifier_json(json.dumps(identifier))
+            for identifier in json.loads(request.GET.get('identifiers', '[]'))]
+    except (ValueError, AttributeError):
+        return HttpResponseBadRequest('Invalid identifiers')
+    return HttpResponse(workspace_item.adapter.html(
+            identifiers=identifiers,
+            layout_options={'add_snippet': True,
+                            'legend': True,
+                            'request': request}))
+
+
+def saved_workspace_item_popup(request):
+    """Return popup html of the *saved* workspace item.
+    """
+    return workspace_item_popup(request, item_class=WorkspaceStorageItem)
+
+
 def group_collage_items(collage_items):
     """
     Group collage items.
@@ -970,9 +1071,22 @@ def popup_collage_json(collage_items, popup_id, request=None):
         identifiers = [collage_item.identifier for
                        collage_item in collage_items]
 
-        html.append(
-            collage_item.html(identifiers=identifiers, is_collage=True,
-                              request=request))
+        # The collage html is cached like adapter.html_default() does.
+        html_key = None
+        if collage_item.adapter is not None:
+            html_key = collage_item.adapter.html_cache_key(
+                identifiers, {'is_collage': True, 'request': request},
+                'collage')
+        item_html = None
+        if html_key is not None:
+            item_html = cache.get(html_key)
+        if item_html is None:
+            item_html = collage_item.html(
+                identifiers=identifiers, is_collage=True, request=request)
+            if html_key is not None:
+                cache.set(html_key, item_html,
+                          settings.MAP_HTML_CACHE_TIMEOUT)
+        html.append(item_html)
 
     result = {'id': popup_id,
               'html': html,
@@ -1052,6 +1166,106 @@ Map stuff
 """
 
 
+def wms_workspace(request, workspace_storage_id=None,
+                  workspace_storage_slug=None):
+    """Return workspace for the wms views.
+
+    if workspace_storage_id and workspace_storage_slug are both not
+    provided, it will take your own WorkspaceEdit.
+    """
+    if workspace_storage_id is not None:
+        workspace_storage_id = int(workspace_storage_id)
+        return get_object_or_404(
+            WorkspaceStorage, pk=workspace_storage_id)
+    elif workspace_storage_slug is not None:
+        return get_object_or_404(
+            WorkspaceStorage, secret_slug=workspace_storage_slug)
+    return WorkspaceEdit.get_or_create(
+        request.session.session_key, request.user)
+
+
+def render_workspace_item(request, workspace_item, req_layers, bbox,
+                          width, height, srs):
+    """Return PNG data of workspace_item drawn by mapnik.
+
+    workspace_item may be None, that results in a transparent image.
+    """
+    img = render_workspace_item_image(
+        request, workspace_item, req_layers, bbox, width, height, srs)
+    return img.tostring('png')
+
+
+def render_workspace_item_image(request, workspace_item, req_layers, bbox,
+                                width, height, srs, buffer_size=None):
+    """Return mapnik.Image of workspace_item, see render_workspace_item.
+
+    Buffer_size is the number of pixels around the image that mapnik
+    takes into account when placing labels and symbols.
+    """
+    workspace_items = [workspace_item] if workspace_item is not None else []
+    pool_key = map_pool_key(request, workspace_items,
+                            req_layers, srs, buffer_size)
+    mapnik_map = mapnik_helper.checkout_map(pool_key, width, height)
+    if mapnik_map is None:
+        # Map settings
+        mapnik_map = mapnik.Map(width, height)
+        # Setup mapnik srs.
+        mapnik_map.srs = coordinates.srs_to_mapnik_projection[srs]
+        mapnik_map.background = mapnik.Color('transparent')
+        if buffer_size is not None:
+            mapnik_map.buffer_size = buffer_size
+        #m.background = mapnik.Color('blue')
+
+        if workspace_item is not None:
+            logger.debug("Drawing layer for %s..." % workspace_item)
+            try:
+                layers, styles = workspace_item.adapter.layer(
+                    layer_ids=req_layers,
+                    request=request)
+                layers.reverse()  # first item should be drawn on top (=last)
+                for layer in layers:
+                    mapnik_map.layers.append(layer)
+                for name in styles:
+                    mapnik_map.append_style(name, styles[name])
+            except:
+                # This part may NEVER crash. Layers from workspace items
+                # should prevent crashing themselves, but you never know.
+                logger.exception(
+                    "Error in drawing layer for %s" % workspace_item)
+                # Don't keep the incomplete map.
+                pool_key = None
+
+    #Zoom and create image
+    logger.debug("Zooming to box...")
+    mapnik_map.zoom_to_box(mapnik.Envelope(*bbox))
+    # mapnik_map.zoom_to_box(layer.envelope())
+    # just have mapnik render the png, as it should be faster
+    # unfortunately mapnik doesn't support rendering to a stream (yet?)
+    img = mapnik.Image(width, height)
+    logger.debug("Rendering map...")
+    mapnik.render(mapnik_map, img)
+    mapnik_helper.checkin_map(pool_key, mapnik_map)
+    return img
+
+
+def map_pool_key(request, workspace_items, *parts):
+    """Return key for the mapnik_helper.map_pool() or None.
+
+    The key identifies the contents of a map with the given workspace
+    items (see WorkspaceItemMixin.content_key) and extra parts. None
+    means the map must not be pooled.
+    """
+    if mapnik_helper.map_pool() is None:
+        return None
+    content_keys = []
+    for workspace_item in workspace_items:
+        content_key = workspace_item.content_key(request)
+        if content_key is None:
+            return None
+        content_keys.append(content_key)
+    return disk_cache.cache_key(tuple(content_keys), *parts)
+
+
 def wms(request, workspace_item_id, workspace_storage_id=None,
         workspace_storage_slug=None):
     """Return PNG as WMS service for given workspace_edit or
@@ -1059,20 +1273,14 @@ def wms(request, workspace_item_id, workspace_storage_id=None,
 
     if workspace_storage_id and workspace_storage_slug are both not
     provided, it will take your own WorkspaceEdit.
+
+    Rendered images are kept in the disk_cache.tile_cache(), see
+    cached_render_workspace_item.
     """
 
     workspace_item_id = int(workspace_item_id)
-
-    if workspace_storage_id is not None:
-        workspace_storage_id = int(workspace_storage_id)
-        workspace = get_object_or_404(
-            WorkspaceStorage, pk=workspace_storage_id)
-    elif workspace_storage_slug is not None:
-        workspace = get_object_or_404(
-            WorkspaceStorage, secret_slug=workspace_storage_slug)
-    else:
-        workspace = WorkspaceEdit.get_or_create(
-            request.session.session_key, request.user)
+    workspace = wms_workspace(request, workspace_storage_id,
+                              workspace_storage_slug)
 
     # WMS standard parameters
     width = int(request.GET.get('WIDTH'))
@@ -1084,43 +1292,177 @@ def wms(request, workspace_item_id, workspace_storage_id=None,
     srs = request.GET.get('SRS')
     # TODO: check that they're not none
 
-    # Map settings
-    mapnik_map = mapnik.Map(width, height)
-    # Setup mapnik srs.
-    mapnik_map.srs = coordinates.srs_to_mapnik_projection[srs]
-    mapnik_map.background = mapnik.Color('transparent')
-    #m.background = mapnik.Color('blue')
-
-    workspace_items = workspace.workspace_items.filter(
-        visible=True, id=workspace_item_id).reverse()
     # len(workspace_items) should be 1:
     # we no longer combine all generated layers into a single WMS layer
-    for workspace_item in workspace_items:
-        logger.debug("Drawing layer for %s..." % workspace_item)
-        try:
-            layers, styles = workspace_item.adapter.layer(
-                layer_ids=req_layers,
-                request=request)
-            layers.reverse()  # first item should be drawn on top (=last)
-            for layer in layers:
-                mapnik_map.layers.append(layer)
-            for name in styles:
-                mapnik_map.append_style(name, styles[name])
-        except:
-            # This part may NEVER crash. Layers from workspace items
-            # should prevent crashing themselves, but you never know.
-            logger.exception("Error in drawing layer for %s" % workspace_item)
+    workspace_items = workspace.workspace_items.filter(
+        visible=True, id=workspace_item_id)
+    workspace_item = workspace_items[0] if workspace_items else None
 
-    #Zoom and create image
-    logger.debug("Zooming to box...")
-    mapnik_map.zoom_to_box(mapnik.Envelope(*bbox))
-    # mapnik_map.zoom_to_box(layer.envelope())
-    # just have mapnik render the png, as it should be faster
-    # unfortunately mapnik doesn't support rendering to a stream (yet?)
-    img = mapnik.Image(width, height)
-    logger.debug("Rendering map...")
-    mapnik.render(mapnik_map, img)
-    response = HttpResponse(img.tostring('png'), content_type='image/png')
+    key = workspace_item_png_key(
+        request, workspace_item, req_layers, bbox, width, height, srs)
+    png = cached_render_workspace_item(
+        request, workspace_item, req_layers, bbox, width, height, srs, key)
+    return HttpResponse(png, content_type='image/png')
+
+
+def workspace_item_png_key(request, workspace_item, req_layers, bbox,
+                           width, height, srs):
+    """Return disk cache key for a rendered workspace item.
+
+    Returns None if the image must not be cached.
+    """
+    if workspace_item is None:
+        return None
+    return png_key(workspace_item.content_key(request),
+                   req_layers, bbox, width, height, srs)
+
+
+def png_key(content_key, req_layers, bbox, width, height, srs):
+    """Return disk cache key, None if content_key is None."""
+    if content_key is None:
+        return None
+    return disk_cache.cache_key(
+        content_key, req_layers, bbox, width, height, srs)
+
+
+def cached_render_workspace_item(request, workspace_item, req_layers, bbox,
+                                 width, height, srs, key):
+    """Return png from the disk_cache.tile_cache() or render it.
+
+    Key is the result of workspace_item_png_key(), None means 'do
+    not cache'.
+    """
+    tile_cache = disk_cache.tile_cache()
+    if tile_cache is None:
+        key = None
+    if key is not None:
+        png = tile_cache.get(key)
+        if png is not None:
+            return png
+
+    png = render_workspace_item(request, workspace_item, req_layers, bbox,
+                                width, height, srs)
+    if key is not None:
+        tile_cache.set(key, png)
+    return png
+
+
+# Rendering the same metatile twice in one process is useless: threads
+# that need the same metatile wait for each other.
+_metatile_locks = [threading.Lock() for i in range(32)]
+
+
+def cached_render_metatile(request, workspace_item, content_key, req_layers,
+                           grid, zoom, x, y, metatile_size):
+    """Return png of tile zoom/x/y, rendered as part of a metatile.
+
+    The block of metatile_size x metatile_size tiles around zoom/x/y
+    is rendered with a single mapnik.render() call. This means one
+    query per datasource instead of one per tile and no labels that
+    are cut off at tile edges. All tiles of the block are stored in
+    the disk_cache.tile_cache(), so the requests for the neighbouring
+    tiles that follow are cache hits.
+    """
+    tile_cache = disk_cache.tile_cache()
+    size = grid.tile_size
+
+    def tile_key(tile_x, tile_y):
+        return png_key(content_key, req_layers,
+                       grid.bbox(zoom, tile_x, tile_y), size, size, grid.srs)
+
+    key = tile_key(x, y)
+    png = tile_cache.get(key)
+    if png is not None:
+        return png
+
+    # The metatile's top left tile, the block is clipped to the grid.
+    meta_x = x - x % metatile_size
+    meta_y = y - y % metatile_size
+    num_tiles = 2 ** zoom
+    width = min(metatile_size, num_tiles - meta_x)
+    height = min(metatile_size, num_tiles - meta_y)
+
+    lock = _metatile_locks[
+        hash((content_key, zoom, meta_x, meta_y)) % len(_metatile_locks)]
+    with lock:
+        # Maybe another thread just rendered it.
+        png = tile_cache.get(key)
+        if png is not None:
+            return png
+        img = render_workspace_item_image(
+            request, workspace_item, req_layers,
+            grid.bbox(zoom, meta_x, meta_y, width, height),
+            width * size, height * size, grid.srs,
+            buffer_size=size // 2)
+        for i in range(width):
+            for j in range(height):
+                tile_png = img.view(i * size, j * size,
+                                    size, size).tostring('png')
+                tile_cache.set(tile_key(meta_x + i, meta_y + j), tile_png)
+                if (meta_x + i, meta_y + j) == (x, y):
+                    png = tile_png
+    return png
+
+
+def tile(request, workspace_item_id, grid_name, zoom, x, y,
+         workspace_storage_id=None, workspace_storage_slug=None):
+    """Return PNG tile zoom/x/y of the given tile grid.
+
+    Unlike with wms(), the tile boundaries are fixed, so tiles are
+    cached on the server (see cached_render_workspace_item) and can be
+    cached by the browser as well. Tiles of items that depend on the
+    session (period, custom legend) are only revalidated with their
+    ETag.
+
+    Optional GET parameter LAYERS is passed to the adapter like in
+    wms().
+
+    With MAP_METATILE_SIZE = N > 1, tiles are rendered in blocks of
+    NxN tiles when the tile cache is enabled, see
+    cached_render_metatile.
+    """
+    grid = tiles.GRIDS.get(grid_name)
+    zoom, x, y = int(zoom), int(x), int(y)
+    if grid is None or not grid.is_valid(zoom, x, y):
+        return HttpResponseNotFound()
+
+    workspace = wms_workspace(request, workspace_storage_id,
+                              workspace_storage_slug)
+    workspace_item = get_object_or_404(
+        workspace.workspace_items, visible=True, pk=int(workspace_item_id))
+    req_layers = [layer.strip() for layer in
+                  request.GET.get('LAYERS', '').split(',') if layer.strip()]
+    bbox = grid.bbox(zoom, x, y)
+
+    content_key = workspace_item.content_key(request)
+    key = png_key(content_key, req_layers, bbox,
+                  grid.tile_size, grid.tile_size, grid.srs)
+    if key is not None and (
+        request.META.get('HTTP_IF_NONE_MATCH') == '"%s"' % key):
+        return HttpResponseNotModified()
+
+    metatile_size = getattr(settings, 'MAP_METATILE_SIZE', 1)
+    if (metatile_size > 1 and key is not None and
+        disk_cache.tile_cache() is not None):
+        png = cached_render_metatile(
+            request, workspace_item, content_key, req_layers,
+            grid, zoom, x, y, metatile_size)
+    else:
+        png = cached_render_workspace_item(
+            request, workspace_item, req_layers, bbox,
+            grid.tile_size, grid.tile_size, grid.srs, key)
+    response = HttpResponse(png, content_type='image/png')
+    if key is None:
+        add_never_cache_headers(response)
+        return response
+    response['ETag'] = '"%s"' % key
+    adapter = workspace_item.adapter
+    if adapter.is_animatable or adapter.allow_custom_legend:
+        patch_cache_control(response, private=True, max_age=0)
+    else:
+        patch_cache_control(
+            response, max_age=getattr(settings, 'MAP_TILE_HTTP_MAX_AGE',
+                                      3600))
     return response
 
 
@@ -1129,23 +1471,94 @@ def search(workspace, google_x, google_y, radius):
 
     Return a list of found results in "adapter.search" dictionary
     format.
+
+    The workspace items are searched concurrently (see
+    workers.concurrent_map). Items that take longer than
+    MAP_SEARCH_TIMEOUT seconds (default 10) are left out.
+
+    Items whose extent is too far away from the coordinates are
+    skipped, unless MAP_SEARCH_EXTENT_FILTER is False. The extent is
+    looked up in the worker, so extents that aren't cached yet are
+    computed concurrently and within the timeout as well.
     """
     found = []
-
+    adapters = []
+    extent_filter = getattr(settings, 'MAP_SEARCH_EXTENT_FILTER', True)
     for workspace_item in workspace.workspace_items.filter(
         visible=True):
+        # Get the adapter here: it can delete broken workspace items.
+        adapter = workspace_item.adapter
+        if adapter is not None:
+            adapters.append((workspace_item, adapter))
 
+    def search_item(item):
+        workspace_item, adapter = item
         try:
-            search_results = workspace_item.adapter.search(
-                google_x, google_y, radius=radius)
-            found += search_results
+            if extent_filter and not workspace_item.extent_contains(
+                google_x, google_y, radius):
+                return []
+            return adapter.search(google_x, google_y, radius=radius)
         except:
             logger.exception(
                 "Crashed while calling search on %s" %
                 workspace_item)
+            return []
+
+    results = workers.concurrent_map(
+        search_item, adapters,
+        timeout=getattr(settings, 'MAP_SEARCH_TIMEOUT', 10))
+    for (workspace_item, adapter), (search_results, error) in zip(
+        adapters, results):
+        if error is not None:
+            logger.warning("Search on %s did not finish: %r",
+                           workspace_item, error)
+            continue
+        found += search_results
     return found
 
 
+# Hover results per workspace content and grid cell, see hover_name().
+_hover_cache = None
+# Hover grid cells are this fraction of the search radius.
+HOVER_CELL_FRACTION = 0.25
+
+
+def hover_name(workspace, google_x, google_y, radius):
+    """Return name of the nearest object, or None if nothing is found.
+
+    Hovering fires a search at every mouse move. Results are kept
+    for MAP_HOVER_CACHE_TIMEOUT seconds (default 30) per workspace
+    content and per grid cell of a quarter of the search radius, so
+    small mouse moves don't search again. MAP_HOVER_CACHE_SIZE
+    (default 1000) is the number of results kept in this process.
+    """
+    global _hover_cache
+    if _hover_cache is None:
+        _hover_cache = LRUCache(
+            getattr(settings, 'MAP_HOVER_CACHE_SIZE', 1000),
+            ttl=getattr(settings, 'MAP_HOVER_CACHE_TIMEOUT', 30))
+    cell_size = radius * HOVER_CELL_FRACTION
+    if cell_size > 0:
+        cell = (int(google_x // cell_size), int(google_y // cell_size))
+    else:
+        cell = (google_x, google_y)
+    contents = sorted([
+            (workspace_item.adapter_class, workspace_item.adapter_layer_json)
+            for workspace_item in workspace.workspace_items.filter(
+                visible=True)])
+    key = disk_cache.cache_key(contents, radius, cell)
+
+    missing = object()
+    name = _hover_cache.get(key, missing)
+    if name is missing:
+        found = search(workspace, google_x, google_y, radius)
+        name = None
+        if found:
+            name = min(found, key=lambda item: item['distance'])['name']
+        _hover_cache.set(key, name)
+    return name
+
+
 # L3
 def search_coordinates(request,
                        workspace_storage_id=None,
@@ -1198,6 +1611,24 @@ def search_coordinates(request,
             stored_workspace_id = request.GET.get('stored_workspace_id', None)
             workspace = WorkspaceStorage.objects.get(pk=stored_workspace_id)
 
+    if format == 'name':
+        # Hovering: only the name of the nearest object is needed.
+        name = hover_name(workspace, google_x, google_y, radius)
+        if name is None:
+            return popup_json([], request=request)
+        result = {}
+        result['name'] = name
+        # x, y = coordinates.google_to_srs(google_x, google_y, srs)
+        # result['x'] = x
+        # result['y'] = y
+
+        # For the x/y we use the original x/y value to position
+        # the popup to the lower right of the cursor to prevent
+        # click propagation problems.
+        result['x'] = x + (radius / 10)
+        result['y'] = y - (radius / 10)
+        return HttpResponse(json.dumps(result))
+
     # The actual search!
     found = search(workspace, google_x, google_y, radius)
     logger.debug('>>> FOUND <<< %s\n%s' % (format, repr(found)))
@@ -1205,20 +1636,7 @@ def search_coordinates(request,
     if found:
         # ``found`` is a list of dicts {'distance': ..., 'timeserie': ...}.
         found.sort(key=lambda item: item['distance'])
-        if format == 'name':
-            result = {}
-            result['name'] = found[0]['name']
-            # x, y = coordinates.google_to_srs(google_x, google_y, srs)
-            # result['x'] = x
-            # result['y'] = y
-
-            # For the x/y we use the original x/y value to position
-            # the popup to the lower right of the cursor to prevent
-            # click propagation problems.
-            result['x'] = x + (radius / 10)
-            result['y'] = y - (radius / 10)
-            return HttpResponse(json.dumps(result))
-        elif format == 'object':
+        if format == 'object':
             result = [{'id':f['identifier'], 'name':f['name']}
             for f in found]
 
@@ -1514,29 +1932,34 @@ def save_map_as_image(request):
 def create_mapnik_image(request, data):
     """TODO: remove copy-pasting.
     """
-    # Map settings
-    mapnik_map = mapnik.Map(data['width'], data['height'])
-    layers = data['layers']
-    # Setup mapnik srs.
-    mapnik_map.srs = coordinates.srs_to_mapnik_projection[data['srs']]
-    mapnik_map.background = mapnik.Color(data['color'])
-    #m.background = mapnik.Color(data['color')]
-
     workspace = WorkspaceEdit.get_or_create(
         request.session.session_key, user=request.user)
 
-    workspace_items = workspace.workspace_items.filter(
-        visible=True).reverse()
+    workspace_items = list(workspace.workspace_items.filter(
+        visible=True).reverse())
+
+    pool_key = map_pool_key(request, workspace_items, data['layers'],
+                            data['srs'], data['color'])
+    mapnik_map = mapnik_helper.checkout_map(
+        pool_key, data['width'], data['height'])
+    if mapnik_map is None:
+        # Map settings
+        mapnik_map = mapnik.Map(data['width'], data['height'])
+        layers = data['layers']
+        # Setup mapnik srs.
+        mapnik_map.srs = coordinates.srs_to_mapnik_projection[data['srs']]
+        mapnik_map.background = mapnik.Color(data['color'])
+        #m.background = mapnik.Color(data['color')]
 
-    for workspace_item in workspace_items:
-        logger.debug("Drawing layer for %s..." % workspace_item)
-        layers, styles = workspace_item.adapter.layer(layer_ids=layers,
-                                                      request=request)
-        layers.reverse()  # first item should be drawn on top (=last)
-        for layer in layers:
-            mapnik_map.layers.append(layer)
-        for name in styles:
-            mapnik_map.append_style(name, styles[name])
+        for workspace_item in workspace_items:
+            logger.debug("Drawing layer for %s..." % workspace_item)
+            layers, styles = workspace_item.adapter.layer(layer_ids=layers,
+                                                          request=request)
+            layers.reverse()  # first item should be drawn on top (=last)
+            for layer in layers:
+                mapnik_map.layers.append(layer)
+            for name in styles:
+                mapnik_map.append_style(name, styles[name])
 
     #Zoom and create image
     logger.debug("Zooming to box...")
@@ -1544,6 +1967,7 @@ def create_mapnik_image(request, data):
     img = mapnik.Image(data['width'], data['height'])
     logger.debug("Rendering map...")
     mapnik.render(mapnik_map, img)
+    mapnik_helper.checkin_map(pool_key, mapnik_map)
 
     return img
 
@@ -1592,6 +2016,34 @@ def mapnik_image_to_stream(request, data, img):
 
 # Statistics
 
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def csv_chunks(rows):
+    """Yield csv of rows in chunks of about CSV_CHUNK_SIZE bytes.
+
+    Rows can be a generator, so the csv never has to be in memory
+    completely.
+    """
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CSV_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf = StringIO.StringIO()
+            writer = csv.writer(buf)
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def csv_response(rows, filename):
+    """Return response that streams rows as csv attachment."""
+    response = StreamingHttpResponse(csv_chunks(rows), content_type='text/csv')
+    response['Content-Disposition'] = ('attachment; filename="%s"' % filename)
+    return response
+
+
 def statistics_csv(request):
     """
     Return csv for statistics of given collage_items.
@@ -1610,28 +2062,21 @@ def statistics_csv(request):
     start_date, end_date = current_start_end_dates(request)
     collage = CollageEdit.get_or_create(
         request.session.session_key, request.user)
-    collage_items = collage.collage_items.filter(visible=True)
-    statistics = []
-    for collage_item in collage_items:
-        statistics.extend(collage_item.statistics(start_date, end_date))
+    collage_items = list(collage.collage_items.filter(visible=True))
 
-    # Statistics as csv.
-    filename = 'statistieken.csv'
+    def rows():
+        yield ['Naam', 'Periode', 'Minimum', 'Maximum', 'Gemiddeld',
+               'Percentiel grens', 'Percentiel waarde',
+               'Grenswaarde', 'Aantal boven grenswaarde',
+               'Aantal onder grenswaarde']
+        for row in collage_items_statistics(
+            collage_items, start_date, end_date):
+            yield [
+                row['name'], row['period'], row['min'], row['max'],
+                row['avg'], row['percentile_value'], row['percentile'],
+                row['boundary_value'], row['count_lt'], row['count_gte']]
 
-    # Make the csv output.
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = ('attachment; filename="%s"' % filename)
-    writer = csv.writer(response)
-    writer.writerow(['Naam', 'Periode', 'Minimum', 'Maximum', 'Gemiddeld',
-                     'Percentiel grens', 'Percentiel waarde',
-                     'Grenswaarde', 'Aantal boven grenswaarde',
-                     'Aantal onder grenswaarde'])
-    for row in statistics:
-        writer.writerow([
-                row['name'], row['period'], row['min'], row['max'], row['avg'],
-                row['percentile_value'], row['percentile'],
-                row['boundary_value'], row['count_lt'], row['count_gte']])
-    return response
+    return csv_response(rows(), 'statistieken.csv')
 
 
 # Adapter related views
@@ -1729,6 +2174,9 @@ class AdapterImageView(AdapterMixin, ImageMixin, View):
     - width, height (optional)
     - start_date, end_date (optional, iso8601 format, default current)
     - layout_extra (optional)
+
+    Rendered images can be cached on disk, see disk_cache.graph_cache() and
+    WorkspaceItemAdapter.image_data_version().
     """
 
     def get(self, request, *args, **kwargs):
@@ -1744,10 +2192,55 @@ class AdapterImageView(AdapterMixin, ImageMixin, View):
         # Add animation slider position, info from session data.
         layout_extra = self.layout_extra_from_request()
 
-        return current_adapter.image(
-            identifier_list, start_date, end_date,
-            width, height,
-            layout_extra=layout_extra)
+        key = self.graph_key(current_adapter, kwargs['adapter_class'],
+                             identifier_list, start_date, end_date,
+                             width, height, layout_extra)
+        if key is None:
+            return current_adapter.image(
+                identifier_list, start_date, end_date,
+                width, height,
+                layout_extra=layout_extra)
+        if request.META.get('HTTP_IF_NONE_MATCH') == '"%s"' % key:
+            return HttpResponseNotModified()
+
+        png = disk_cache.graph_cache().get(key)
+        if png is None:
+            response = current_adapter.image(
+                identifier_list, start_date, end_date,
+                width, height,
+                layout_extra=layout_extra)
+            if (response.status_code != 200 or
+                response.get('Content-Type') != 'image/png'):
+                return response
+            png = response.content
+            disk_cache.graph_cache().set(key, png)
+        response = HttpResponse(png, content_type='image/png')
+        response['ETag'] = '"%s"' % key
+        # Private: without dt_start and dt_end, the dates come from the
+        # session.
+        patch_cache_control(
+            response, private=True,
+            max_age=getattr(settings, 'MAP_GRAPH_HTTP_MAX_AGE', 0))
+        return response
+
+    def graph_key(self, adapter, adapter_class, identifiers, start_date,
+                  end_date, width, height, layout_extra):
+        """Return disk cache key of the image, None if it isn't cached."""
+        if disk_cache.graph_cache() is None:
+            return None
+        data_version = adapter.image_data_version(
+            identifiers, start_date, end_date)
+        if data_version is None:
+            return None
+        return disk_cache.cache_key(
+            'graph', adapter_class,
+            self.request.GET.get('adapter_layer_json'),
+            json.dumps(identifiers, sort_keys=True),
+            start_date, end_date, width, height,
+            json.dumps(layout_extra, sort_keys=True),
+            data_version, translation.get_language(),
+            # The graph has a line at 'now'.
+            datetime.date.today())
 
 
 class AdapterValuesView(AdapterMixin, UiView):
@@ -1769,24 +2262,21 @@ class AdapterValuesView(AdapterMixin, UiView):
         identifier = self.identifier()
         start_date, end_date = self.start_end_dates_from_request()
 
-        self.values = adapter.values(identifier, start_date, end_date)
-
         self.name = adapter.location(**identifier).get('name', 'export')
 
         if output_type == 'csv':
             filename = ('%s.csv' % (self.name)).encode('us-ascii',
                                                        errors='ignore')
-            # Make the csv output.
-            response = HttpResponse(mimetype='text/csv')
-            response['Content-Disposition'] = (
-                'attachment; filename="%s"' %
-                filename)
-            writer = csv.writer(response)
-            writer.writerow(['Datum + tijdstip', 'Waarde', 'Eenheid'])
-            for row in self.values:
-                writer.writerow([row['datetime'], row['value'], row['unit']])
-            return response
+
+            def rows():
+                yield ['Datum + tijdstip', 'Waarde', 'Eenheid']
+                for row in adapter.values_iter(
+                    identifier, start_date, end_date):
+                    yield [row['datetime'], row['value'], row['unit']]
+
+            return csv_response(rows(), filename)
         else:
+            self.values = adapter.values(identifier, start_date, end_date)
             # Make html table using self.values
             return super(AdapterValuesView, self).get(
                 request, *args, **kwargs)
@@ -1812,6 +2302,17 @@ class AdapterFlotGraphDataView(AdapterMixin, APIView):
     - identifier (required, multiple supported)
     - start_date, end_date (optional, iso8601 format, default current)
     - layout_extra (optional)
+    - width (optional, in pixels): reduce lines to their min and max
+      value per pixel
+    - encoding (optional): 'columnar' for separate 'x' and 'y' lists per
+      series instead of 'data' pairs, 'delta' for columnar with the
+      differences between the x values
+    - since (optional, javascript timestamp): only return points after
+      it, for updating a graph the client already has (400 if it isn't
+      a valid timestamp)
+
+    The response has an ETag of its content; a request with a matching
+    If-None-Match gets a 304.
     """
 
     @never_cache
@@ -1823,14 +2324,53 @@ class AdapterFlotGraphDataView(AdapterMixin, APIView):
         identifier_list = self.identifiers()
 
         start_date, end_date = self.start_end_dates_from_request()
+        fetch_start_date = start_date
+
+        since = self.request.GET.get('since', None)
+        if since is not None:
+            try:
+                since = float(since)
+                # Timestamps are in local time (see mk_js_timestamp), a
+                # day extra is enough for any timezone.
+                since_date = (
+                    datetime.datetime.fromtimestamp(since / 1000) -
+                    datetime.timedelta(days=1))
+            except (ValueError, OverflowError):
+                return HttpResponseBadRequest('Invalid since')
+            if getattr(start_date, 'tzinfo', None) is not None:
+                since_date = since_date.replace(tzinfo=start_date.tzinfo)
+            fetch_start_date = max(start_date, since_date)
 
         # Add animation slider position, info from session data.
         layout_extra = self.layout_extra_from_request()
 
         result = current_adapter.flot_graph_data(
-            identifier_list, start_date, end_date,
+            identifier_list, fetch_start_date, end_date,
             layout_extra=layout_extra)
-        return RestResponse(result)
+
+        if isinstance(result, dict) and since is not None:
+            result['x_min'] = mk_js_timestamp(start_date)
+            result['since'] = since
+            if result.get('data'):
+                result['data'] = flot_data_since(result['data'], since)
+
+        if isinstance(result, dict) and result.get('data'):
+            width = self.request.GET.get('width', None)
+            if width:
+                result['data'] = downsample_flot_data(result['data'],
+                                                      max(int(width), 1))
+            encoding = self.request.GET.get('encoding', None)
+            if encoding in ('columnar', 'delta'):
+                result['data'] = columnar_flot_data(
+                    result['data'], delta=(encoding == 'delta'))
+
+        etag = '"%s"' % hashlib.sha1(
+            json.dumps(result, sort_keys=True, default=repr)).hexdigest()
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        response = RestResponse(result)
+        response['ETag'] = etag
+        return response
 
 
 # TODO: move this one over to a new fields.py.
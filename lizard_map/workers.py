@@ -0,0 +1,145 @@
+"""
+Run slow calls (adapter searches, statistics) concurrently.
+
+Adapters often wait for a database or a remote service. Calling them one
+after another means the user waits for the sum of all latencies; with
+threads it's the slowest one, and with a timeout not even that.
+
+Every concurrent_map() call starts its own daemon threads. A call that
+hangs keeps only its own thread busy, it can't use up threads that
+other requests need.
+"""
+import Queue
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import translation
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerTimeout(Exception):
+    """The call did not finish in time."""
+    pass
+
+
+class _Call(object):
+    """State of one function(item) call in concurrent_map()."""
+
+    def __init__(self, item):
+        self.item = item
+        self.started = None
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+def _run(function, item, language):
+    """Call function(item) in a worker thread like in the request."""
+    if language:
+        translation.activate(language)
+    try:
+        return function(item)
+    finally:
+        # Django database connections are per thread; don't leave them
+        # open when the thread ends.
+        connection.close()
+        translation.deactivate()
+
+
+def _worker(function, calls, condition, language):
+    """Run the queued calls until there are none left."""
+    while True:
+        try:
+            call = calls.get_nowait()
+        except Queue.Empty:
+            return
+        with condition:
+            if call.done:
+                # Timed out before it started.
+                continue
+            call.started = time.time()
+            condition.notify_all()
+        try:
+            result, error = _run(function, call.item, language), None
+        except Exception, e:
+            result, error = None, e
+        with condition:
+            if call.done:
+                # Timed out; a new thread has taken over the queue.
+                return
+            call.result, call.error = result, error
+            call.done = True
+            condition.notify_all()
+
+
+def _start_thread(target, args):
+    thread = threading.Thread(target=target, args=args)
+    # Don't let hanging calls keep the process alive.
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def concurrent_map(function, items, timeout=None, per_item=False):
+    """Call function(item) for all items in worker threads.
+
+    Returns a list of (result, error) in the order of items: error is
+    None, the exception function raised or a WorkerTimeout if the
+    result wasn't there within timeout seconds from the start. With
+    per_item, every call gets timeout seconds from the moment it
+    starts running instead, so calls that wait for a free thread don't
+    lose time. Calls that time out keep running in the background,
+    their result is ignored.
+
+    MAP_WORKER_THREADS is the maximum number of threads per call
+    (default 10, 0 runs everything in the calling thread).
+    """
+    items = list(items)
+    max_threads = getattr(settings, 'MAP_WORKER_THREADS', 10)
+    if not max_threads:
+        results = []
+        for item in items:
+            try:
+                results.append((function(item), None))
+            except Exception, e:
+                results.append((None, e))
+        return results
+
+    calls = [_Call(item) for item in items]
+    queue = Queue.Queue()
+    for call in calls:
+        queue.put(call)
+    condition = threading.Condition()
+    args = (function, queue, condition, translation.get_language())
+    for i in range(min(max_threads, len(calls))):
+        _start_thread(_worker, args)
+
+    start = time.time()
+    with condition:
+        pending = calls
+        while pending:
+            wait = None
+            if timeout is not None:
+                now = time.time()
+                for call in pending:
+                    started = call.started if per_item else start
+                    if started is None:
+                        continue
+                    remaining = started + timeout - now
+                    if remaining > 0:
+                        if wait is None or remaining < wait:
+                            wait = remaining
+                        continue
+                    call.error = WorkerTimeout()
+                    call.done = True
+                    if per_item:
+                        # Its thread hangs: let a new one run the rest.
+                        _start_thread(_worker, args)
+            pending = [call for call in pending if not call.done]
+            if pending:
+                condition.wait(wait)
+    return [(call.result, call.error) for call in calls]
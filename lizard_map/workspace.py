@@ -1,18 +1,26 @@
 
-import os
+import bisect
 import json
 import logging
 
 from django.conf import settings
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
+from lizard_map import aggregation
+from lizard_map import spatial_index
 from lizard_map.adapter import adapter_serialize
+from lizard_map.daterange import SESSION_DT_END
+from lizard_map.daterange import SESSION_DT_RANGETYPE
+from lizard_map.daterange import SESSION_DT_START
+from lizard_map.disk_cache import cache_key
 from lizard_map.fields import Color
-from lizard_map.models import ICON_ORIGINALS
+from lizard_map.mapnik_helper import get_symbol_manager
 from lizard_map.models import Legend
+from lizard_map.models import legend_version
 #from lizard_map.models import Workspace foo
-from lizard_map.symbol_manager import SymbolManager
 
 logger = logging.getLogger('lizard_map.workspace')
 
@@ -47,6 +55,24 @@ class WorkspaceItemAdapter(object):
     allow_custom_legend = False
     support_flot_graph = False
     # ^^^ Set this once flot graphs are supported by the adapter.
+    tile_cacheable = True
+    # ^^^ Set to False if layer() output can change while the layer
+    # arguments stay the same (live data, or data from the request), so
+    # its WMS tiles aren't cached and its mapnik maps aren't pooled.
+    is_stateless = False
+    # ^^^ Set to True if the adapter only depends on its layer arguments
+    # (no per-request state), so one instance can be shared by all
+    # workspace items with the same layer json.
+    html_cacheable = True
+    # ^^^ Set to False if the popup html changes while the layer
+    # arguments, identifiers and period stay the same.
+    html_cache_version = 1
+    # ^^^ Increase when your html() output changes, for instance after
+    # changing its template, to ignore the cached html.
+    aggregate_from_values = False
+    # ^^^ Set to True if value_aggregate() is value_aggregate_default(),
+    # so statistics of many periods can be calculated from one values()
+    # call.
 
     def __init__(self, workspace_item, layer_arguments=None,
                  adapter_class=None):
@@ -130,9 +156,33 @@ class WorkspaceItemAdapter(object):
         grouping_hints that can possibly come from other workspace
         items (use the workspace item id as part of the
         grouping_hint), unless you know what you are doing.
+
+        For layers with many locations, don't loop over all of them:
+        use spatial_index() to find the locations near x, y.
         """
         raise NotImplementedError
 
+    def spatial_index(self, records, data_version=None):
+        """Return spatial_index.SpatialIndex of this adapter's locations.
+
+        Records is a function that returns a list of (google x, google
+        y, item); it is only called if there is no index for this
+        adapter class, layer json and data_version in the process yet.
+        Locations added later are only found once the index expires
+        (MAP_SPATIAL_INDEX_TIMEOUT seconds, default 300), unless you
+        pass a data_version that changes with them, for instance the
+        time of the last import. Use the index in search()::
+
+            index = self.spatial_index(self._location_records)
+            for distance, item in index.radius(x, y, radius):
+                ...
+
+        Or index.nearest(x, y, k=1) for the k nearest items.
+        """
+        return spatial_index.cached_index(
+            (self.adapter_class, self.adapter_layer_json, data_version),
+            records)
+
     def value_aggregate(self, identifier, aggregate_functions,
                         start_date=None, end_date=None):
         """
@@ -159,60 +209,86 @@ class WorkspaceItemAdapter(object):
         """
         return {}
 
+    def value_aggregate_periods(self, identifier, aggregate_functions,
+                                periods):
+        """
+        Calculates aggregated values of identifier for each (start_date,
+        end_date) in periods. Returns list of dicts like
+        value_aggregate().
+
+        By default it calls value_aggregate() for every period, or
+        value_aggregate_periods_default() if aggregate_from_values is
+        set. Override it if your backend can aggregate many periods at
+        once.
+        """
+        if self.aggregate_from_values:
+            return self.value_aggregate_periods_default(
+                identifier, aggregate_functions, periods)
+        return [self.value_aggregate(identifier, aggregate_functions,
+                                     start_date=start_date,
+                                     end_date=end_date)
+                for start_date, end_date in periods]
+
     def values(self, identifier, start_date, end_date):
         """Return values in list of dictionaries (datetime, value, unit)
         """
         raise NotImplementedError
 
+    def values_iter(self, identifier, start_date, end_date):
+        """Return iterator over the values of values().
+
+        Used for csv exports, which stream the values. Override it to
+        fetch the values in parts (for instance a cursor or a year at a
+        time) so a long period doesn't have to be in memory at once.
+        """
+        return iter(self.values(identifier, start_date, end_date))
+
     def value_aggregate_default(self, identifier, aggregate_functions,
                                 start_date, end_date):
         """
         Default implementation for value_aggregate.
+
+        Missing values (None, NaN) are ignored, percentiles are linearly
+        interpolated. Custom aggregates can be added with
+        ``lizard_map.aggregation.register_aggregate()``.
         """
 
-        result = {}
         values = self.values(identifier, start_date, end_date)
+        return aggregation.aggregate(
+            [value['value'] for value in values], aggregate_functions)
+
+    def value_aggregate_periods_default(self, identifier,
+                                        aggregate_functions, periods):
+        """
+        Default implementation for value_aggregate_periods.
+
+        Fetches the values of all periods with one values() call and
+        puts them in periods with a binary search on the sorted
+        datetimes. Like values(), periods include both their start and
+        end date.
+        """
+        if not periods:
+            return []
+        start_date = min([period[0] for period in periods])
+        end_date = max([period[1] for period in periods])
+        values = self.values(identifier, start_date, end_date)
+        try:
+            values = sorted(values, key=lambda value: value['datetime'])
+            datetimes = [value['datetime'] for value in values]
+            bounds = [(bisect.bisect_left(datetimes, period_start_date),
+                       bisect.bisect_right(datetimes, period_end_date))
+                      for period_start_date, period_end_date in periods]
+        except TypeError:
+            # Probably naive versus timezone aware datetimes.
+            logger.exception("Can't divide values into periods")
+            return [self.value_aggregate_default(
+                    identifier, aggregate_functions,
+                    period_start_date, period_end_date)
+                    for period_start_date, period_end_date in periods]
         values_only = [value['value'] for value in values]
-        values_only.sort()  # for percentile function
-        for key, value in aggregate_functions.items():
-            try:
-                # Values are not always numbers - in case of strings
-                # this will result in a TypeError
-                # the sequence can be empty
-                if key == 'min':
-                    result_value = min(values_only)
-                elif key == 'max':
-                    result_value = max(values_only)
-                elif key == 'avg':
-                    result_value = float(sum(values_only)) / len(values_only)
-                elif key == 'count_lt':
-                    if value is None:
-                        result_value = None
-                    else:
-                        result_value = 0
-                        for v in values_only:
-                            if v < value:  # value is boundary value
-                                result_value += 1
-                elif key == 'count_gte':
-                    if value is None:
-                        result_value = None
-                    else:
-                        result_value = 0
-                        for v in values_only:
-                            if v >= value:  # value is boundary value
-                                result_value += 1
-                elif key == 'percentile':
-                    if value is None:
-                        result_value = None
-                    else:
-                        rank = int(value * len(values_only) / 100.0 + 0.5)
-                        result_value = values_only[rank]
-                else:
-                    result_value = None
-            except (ValueError, IndexError, TypeError, ZeroDivisionError):
-                result_value = None
-            result[key] = result_value
-        return result
+        return [aggregation.aggregate(values_only[lower:upper],
+                                      aggregate_functions)
+                for lower, upper in bounds]
 
     def location(self, layout=None, **identifier):
         """
@@ -332,6 +408,16 @@ class WorkspaceItemAdapter(object):
 
         raise NotImplementedError
 
+    def image_data_version(self, identifiers, start_date, end_date):
+        """Return string that changes when the data of image() changes.
+
+        If MAP_GRAPH_CACHE_MAX_SIZE is set, rendered images are cached
+        by their parameters and this version, for instance the time of
+        the last import. The default None means image() isn't cached:
+        adapters opt in by returning a version.
+        """
+        return None
+
     def symbol_url(self, identifier=None, start_date=None, end_date=None,
                    icon_style=None):
         """Return symbol for identifier.
@@ -339,15 +425,34 @@ class WorkspaceItemAdapter(object):
         Implementation: respect the fact when icon_style is already
         given. If it's empty, generate own icon if applicable.
         """
-        sm = SymbolManager(ICON_ORIGINALS, os.path.join(
-                settings.MEDIA_ROOT,
-                'generated_icons'))
+        sm = get_symbol_manager()
         if icon_style is None:
             icon_style = {'icon': 'empty.png'}
         output_filename = sm.get_symbol_transformed(icon_style['icon'],
                                                     **icon_style)
         return settings.MEDIA_URL + 'generated_icons/' + output_filename
 
+    def symbol_sprite(self, icon_styles):
+        """Return sprite sheet info for the symbols of icon_styles.
+
+        Returns a list with a dict for every icon style: sprite_url and
+        the position of the symbol in the sprite: sprite_x, sprite_y,
+        width and height. Returns None if symbol_url is overridden: the
+        symbols in the sprite sheet would differ from symbol_url's.
+        """
+        if (type(self).symbol_url.im_func is not
+            WorkspaceItemAdapter.symbol_url.im_func):
+            return None
+        sprite_filename, offsets = get_symbol_manager().get_sprite(
+            icon_styles)
+        sprite_url = settings.MEDIA_URL + 'generated_icons/' + sprite_filename
+        return [{'sprite_url': sprite_url,
+                 'sprite_x': x,
+                 'sprite_y': y,
+                 'width': width,
+                 'height': height}
+                for x, y, width, height in offsets]
+
     def html(self, snippet_group=None, identifiers=None, layout_options=None):
         """
         Html output for given identifiers. Optionally layout_options
@@ -359,6 +464,33 @@ class WorkspaceItemAdapter(object):
         """
         return 'html output for this adapter is not implemented'
 
+    def html_cache_key(self, identifiers, layout_options=None, *parts):
+        """Return cache key of html() output, None if it isn't cached.
+
+        The html fragment cache is enabled by setting
+        MAP_HTML_CACHE_TIMEOUT (in seconds). The key contains the
+        adapter class, layer json, identifiers, layout options (apart
+        from the request), the period from the request's session, the
+        legend version and extra parts like the template.
+        """
+        timeout = getattr(settings, 'MAP_HTML_CACHE_TIMEOUT', None)
+        if not timeout or not self.html_cacheable:
+            return None
+        layout_options = dict(layout_options or {})
+        request = layout_options.pop('request', None)
+        period = None
+        session = getattr(request, 'session', None)
+        if session is not None:
+            period = [session.get(key) for key in (
+                    SESSION_DT_RANGETYPE, SESSION_DT_START, SESSION_DT_END)]
+        return 'lizard-map.html.%s' % cache_key(
+            self.__class__.__name__, self.html_cache_version,
+            legend_version(), translation.get_language(),
+            getattr(self.workspace_mixin_item, 'adapter_class', None),
+            getattr(self.workspace_mixin_item, 'adapter_layer_json', None),
+            json.dumps(identifiers, sort_keys=True, default=repr),
+            sorted(layout_options.items()), period, parts)
+
     def html_default(self, snippet_group=None, identifiers=None,
                      layout_options=None,
                      template=None, extra_render_kwargs=None):
@@ -382,6 +514,27 @@ class WorkspaceItemAdapter(object):
         if template is None:
             template = 'lizard_map/html_default.html'
 
+        html_key = self.html_cache_key(
+            identifiers, layout_options, template, extra_render_kwargs)
+        if html_key is not None:
+            html = cache.get(html_key)
+            if html is not None:
+                return html
+
+        # Every identifier is looked up once, even though it's needed for
+        # the title and for its collage item.
+        locations = {}
+
+        def location(identifier):
+            identifier_str = {}
+            for k, v in identifier.items():
+                identifier_str[str(k)] = v
+            location_key = json.dumps(identifier_str, sort_keys=True,
+                                      default=repr)
+            if location_key not in locations:
+                locations[location_key] = self.location(**identifier_str)
+            return locations[location_key]
+
         is_collage = False
         if layout_options is not None:
             if 'is_collage' in layout_options:
@@ -389,11 +542,7 @@ class WorkspaceItemAdapter(object):
 
         # Fetch name
         if identifiers:
-            identifier_str = {}
-            for k, v in identifiers[0].items():
-                identifier_str[str(k)] = v
-            location = self.location(**identifier_str)
-            title = location['name']
+            title = location(identifiers[0])['name']
         else:
             title = self.workspace_mixin_item.name
 
@@ -409,12 +558,8 @@ class WorkspaceItemAdapter(object):
         # No export and selection for collages.
         if not is_collage:
             for identifier in identifiers:
-                identifier_str = {}
-                for k, v in identifier.items():
-                    identifier_str[str(k)] = v
-                location = self.location(**identifier_str)
                 collage_item_props.append(
-                    {'name': location['name'],
+                    {'name': location(identifier)['name'],
                      'adapter_class': self.workspace_mixin_item.adapter_class,
                      'adapter_layer_json':
                          self.workspace_mixin_item.adapter_layer_json,
@@ -438,9 +583,12 @@ class WorkspaceItemAdapter(object):
         if extra_render_kwargs is not None:
             render_kwargs.update(extra_render_kwargs)
 
-        return render_to_string(
+        html = render_to_string(
             template,
             render_kwargs)
+        if html_key is not None:
+            cache.set(html_key, html, settings.MAP_HTML_CACHE_TIMEOUT)
+        return html
 
     def legend(self, updates=None):
         """
@@ -478,7 +626,11 @@ class WorkspaceItemAdapter(object):
         when the method "legend" is implemented in the adapter.
 
         Use a fixed formula to calculate legend descriptor, and
-        img_url. Generates image if needed."""
+        img_url. Generates image if needed.
+
+        With MAP_LEGEND_SPRITES (default True) the rows also get the
+        location of their symbol in a single sprite sheet, see
+        symbol_sprite()."""
 
         icon_style_template = {'icon': 'empty.png',
                                'mask': ('empty_mask.png', ),
@@ -486,11 +638,13 @@ class WorkspaceItemAdapter(object):
         if legend_object is not None:
             float_format = legend_object.float_format
             legend_result = []
+            icon_styles = []
 
             # Add < min
             icon_style = icon_style_template.copy()
             icon_style.update({
                     'color': legend_object.too_low_color.to_tuple()})
+            icon_styles.append(icon_style)
             img_url = self.symbol_url(icon_style=icon_style)
             legend_result.append({'img_url': img_url,
                                   'description': (('< %s' % float_format) %
@@ -501,6 +655,7 @@ class WorkspaceItemAdapter(object):
                 color = legend_item['color']
                 icon_style = icon_style_template.copy()
                 icon_style.update({'color': color.to_tuple()})
+                icon_styles.append(icon_style)
                 img_url = self.symbol_url(icon_style=icon_style)
                 legend_row = {'img_url': img_url,
                               'description': (
@@ -514,11 +669,18 @@ class WorkspaceItemAdapter(object):
             icon_style = icon_style_template.copy()
             icon_style.update({
                     'color': legend_object.too_high_color.to_tuple()})
+            icon_styles.append(icon_style)
             img_url = self.symbol_url(icon_style=icon_style)
             legend_result.append({'img_url': img_url,
                                   'description': (('> %s' % float_format) %
                                                   (legend_object.max_value))})
 
+            if getattr(settings, 'MAP_LEGEND_SPRITES', True):
+                sprites = self.symbol_sprite(icon_styles)
+                if sprites is not None:
+                    for legend_row, sprite in zip(legend_result, sprites):
+                        legend_row.update(sprite)
+
         else:
             legend_result = [{'img_url': self.symbol_url(),
                               'description': 'description'}]